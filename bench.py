@@ -0,0 +1,551 @@
+#!/usr/bin/env python2
+
+"""Benchmarks for libned. Each benchmark runs against synthetic (or recorded) data so no Internet access is needed."""
+
+import libned, argparse, sys, time, random, math, re, numpy, os, tempfile, resource, multiprocessing, cgi, warnings, astropy.io.votable, \
+  BaseHTTPServer, SocketServer, threading, subprocess, urlparse, urllib, hashlib, shutil, StringIO, cPickle
+
+class Quiet:
+  """Suppresses the progress printed by libned while timing."""
+  def __enter__(self):
+    self.stdout = sys.stdout
+    sys.stdout = open("/dev/null", "w")
+  def __exit__(self, *exc_info):
+    sys.stdout.close()
+    sys.stdout = self.stdout
+
+def timed(function, *args):
+  """Calls a function and returns its result with the wall and CPU time taken."""
+  wall, cpu = time.time(), time.clock()
+  result = function(*args)
+  return result, time.time() - wall, time.clock() - cpu
+
+def make_source(name="BENCH SOURCE"):
+  """Builds a source with a NED position and extinction, as if those stages had run."""
+  libned.input_fields = ["ned_name"]
+  libned.input_regexp = libned.build_input_regexp()
+  with Quiet():
+    source = libned.Source('"%s"' % name)
+  source.ned_lat, source.ned_lon, source.e_bv = 187.27792, 2.05239, 0.0179
+  return source
+
+NED_SED_PASSBANDS = ["V (Johnson)", "B (Johnson)", "r (SDSS) AB", "r (SDSS PSF) AB", "u (SDSS Petrosian) AB", "K_s (2MASS)", "K_s (2MASS) K20", \
+  "J_14arcsec", "HST F555W", "Spitzer IRAC 3.6 microns", "1.4 GHz (VLA)", "FUV (GALEX)", "H (UKIRT)", "m_p", "60 microns (IRAS)", "0.5-2 keV (ROSAT)"]
+
+def synthetic_ned_sed(rows, seed=0):
+  """Builds a table shaped like a NED SED votable with a given number of rows."""
+  random.seed(seed)
+  columns = [\
+    ("No.", numpy.arange(1, rows+1)), \
+    ("Observed Passband", ["%s %d" % (random.choice(NED_SED_PASSBANDS), random.randint(0, 20)) for row in xrange(rows)]), \
+    ("Photometry Measurement", numpy.random.RandomState(seed).lognormal(0, 2, rows)), \
+    ("Uncertainty", ["+/-%.3f" % random.random() for row in xrange(rows)]), \
+    ("Units", [random.choice(["mag", "Jy", "mJy", "W/m^2/Hz"]) for row in xrange(rows)]), \
+    ("Frequency", 10**numpy.random.RandomState(seed+1).uniform(8, 18, rows)), \
+    ("NED Photometry Measurement", numpy.where(numpy.random.RandomState(seed+2).rand(rows) < 0.05, numpy.nan, numpy.random.RandomState(seed+3).lognormal(-5, 3, rows))), \
+    ("NED Uncertainty", ["+/-%.2e" % random.random() for row in xrange(rows)]), \
+    ("NED Units", ["Jy"]*rows), \
+    ("Refcode", [random.choice(["1983ApJ...272..400H", "2003AJ....126.2081A", "1990ApJS...73..359B", "2006AJ....131.1163S"]) for row in xrange(rows)]), \
+    ("Significance", [random.choice(["", "5 sigma"]) for row in xrange(rows)]), \
+    ("Published frequency", ["%.1f GHz" % random.uniform(1, 100) for row in xrange(rows)]), \
+    ("Frequency Mode", ["Broad-band measurement"]*rows), \
+    ("Coordinates Targeted", ["12h29m06.7s +02d03m09s (Equatorial J2000.0)"]*rows), \
+    ("Spatial Mode", [random.choice(["Total integrated", "Modelled datum", "Core"]) for row in xrange(rows)]), \
+    ("Qualifiers", [random.choice(["", "From new raw data", "line emission"]) for row in xrange(rows)]), \
+    ("Comments", [random.choice(["", "Averaged", "count statistics", "line flux"]) for row in xrange(rows)])\
+   ]
+  array = numpy.rec.fromarrays([numpy.array(values, dtype=object if isinstance(values, list) else None) for name, values in columns], names=[name for name, values in columns])
+  return libned.TableRows(type("Table", (), {"array": numpy.ma.array(array)})(), slice(None))
+
+def legacy_parse_ned_sed(self, index):
+  """The NED SED parser as it was before the filter rules were precompiled, kept for comparison."""
+  all_fields_filter_regexp = re.compile(""" # for finding not allowed patterns in all fields of ned sed output
+    ^line\\b # word line at start of field
+    |
+    ^1983ApJ\.\.\.272\.\.400H\\b # this ref code only at start of field
+    |
+    \\bcount\s+statistics\\b # phrase count statistics anywhere in field
+    """, re.VERBOSE | re.IGNORECASE)
+
+  try:
+    [self.points.append(libned.DataPoint(self, {\
+       "index": index, \
+       "num": len(self.points)+1, \
+       "freq": freq, \
+       "flux": flux, \
+       "data_source": "NED", \
+       "lat": self.ned_lat, \
+       "lon": self.ned_lon, \
+       "offset_from_ned": 0., \
+       "extinction": libned.e_bv_to_extinction(self.e_bv, freq)\
+      })) \
+     for freq, flux, line, passband \
+     in zip(\
+       map(float, self.ned_sed.array["Frequency"].data.tolist()), \
+       map(float, self.ned_sed.array["NED Photometry Measurement"].data.tolist()), \
+       (map(str, line) for line in self.ned_sed.array.tolist()), \
+       map(str, self.ned_sed.array["Observed Passband"].data.tolist())\
+      ) \
+     if \
+       True not in (not not all_fields_filter_regexp.search(entry) for entry in line) \
+       and (\
+         re.search("(^|\s)\(SDSS\\b(?!\s+PSF\)(\s|$)) # in passband matches anything (including nothing) except for psf after sdss", passband, re.VERBOSE | re.IGNORECASE) \
+         if re.search("(^|\s)\(SDSS\\b # in passband matches sdss at start of field or after whitespace", passband, re.VERBOSE | re.IGNORECASE) \
+         else not re.search(""" # search passband for various not allowed patterns
+           \\b(
+           .?_K20
+           |
+           .?_14arcsec
+           |
+           .?_25
+           |
+           .?_26
+           |
+           HST
+           |
+           Spitzer
+           |
+           ISAAC
+           |
+           m_p
+           |
+           CIT
+           |
+           UKIRT
+           |
+           GALEX
+           )\\b
+           """, passband, re.VERBOSE | re.IGNORECASE)\
+        ) \
+       and not math.isnan(flux) \
+       and flux > 0 \
+       and not math.isnan(freq) \
+       and freq > 0\
+    ].pop() # pop to trigger error if list empty
+    print "  Found NED SED data:", self.name
+  except:
+    print "  Can't find NED SED data:", self.name
+
+def bench_sed(args):
+  """Compares parse_ned_sed with the legacy implementation on synthetic SED tables of increasing size."""
+  print "%10s %12s %12s %12s %8s %s" % ("rows", "legacy (s)", "current (s)", "speed-up", "points", "match")
+  for rows in args.rows:
+    table = synthetic_ned_sed(rows)
+    results = {}
+    for name, parse in (("legacy", legacy_parse_ned_sed), ("current", libned.Source.parse_ned_sed)):
+      source = make_source()
+      source.ned_sed = table
+      with Quiet():
+        result, wall, cpu = timed(parse, source, 1)
+      results[name] = (cpu, [(point.freq, point.flux, point.extinction) for point in source.points])
+    print "%10d %12.4f %12.4f %12.1f %8d %s" % (rows, results["legacy"][0], results["current"][0], results["legacy"][0]/max(results["current"][0], 1e-9), len(results["current"][1]), results["legacy"][1] == results["current"][1])
+
+def votable_xml(array):
+  """Serialises a record array as TABLEDATA votable xml in the style of NED's responses."""
+  datatypes = {"i": "int", "f": "double", "O": "char"}
+  return votable_text([(name, datatypes[array.dtype[name].kind]) for name in array.dtype.names], array.tolist())
+
+def votable_text(fields, rows):
+  """Serialises rows of values as TABLEDATA votable xml with (name, datatype) fields, nan or None values being left empty."""
+  lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<VOTABLE version="1.1" xmlns="http://www.ivoa.net/xml/VOTable/v1.1">', "<RESOURCE>", "<TABLE>"]
+  lines += ['<FIELD name="%s" datatype="%s"%s/>' % (name, datatype, ' arraysize="*"' * (datatype == "char")) for name, datatype in fields]
+  lines += ["<DATA>", "<TABLEDATA>"]
+  lines += ["<TR>" + "".join("<TD>%s</TD>" % ("" if value is None or value != value else cgi.escape(str(value))) for value in row) + "</TR>" for row in rows]
+  lines += ["</TABLEDATA>", "</DATA>", "</TABLE>", "</RESOURCE>", "</VOTABLE>"]
+  return "\n".join(lines)
+
+def astropy_parse(stream):
+  with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    return astropy.io.votable.parse_single_table(stream)
+
+def sed_parse(stream):
+  return libned.read_votable(stream, libned.NED_SED_COLUMNS, text_columns=True)
+
+def measure(parse, path, results):
+  """Parses a votable file in a fresh process and reports the time taken and the growth in peak memory."""
+  baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  with open(path, "rb") as stream:
+    table, wall, cpu = timed(parse, stream)
+  results.put((wall, cpu, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline, len(table.array), len(table.array.dtype.names)))
+
+def bench_votable(args):
+  """Compares parsing NED SED votables with astropy and with the column-selective reader, in time and peak memory."""
+  paths = args.file or []
+  for rows in ([] if args.file else args.rows):
+    descriptor, path = tempfile.mkstemp(suffix=".xml")
+    with os.fdopen(descriptor, "w") as stream:
+      stream.write(votable_xml(synthetic_ned_sed(rows).array.data))
+    paths.append(path)
+  print "%-24s %10s %8s %12s %12s %14s %14s" % ("table", "MB", "rows", "astropy (s)", "reader (s)", "astropy (MB)", "reader (MB)")
+  for path in paths:
+    measurements = {}
+    for name, parse in (("astropy", astropy_parse), ("reader", sed_parse)):
+      results = multiprocessing.Queue()
+      process = multiprocessing.Process(target=measure, args=(parse, path, results))
+      process.start()
+      measurements[name] = results.get()
+      process.join()
+    print "%-24s %10.1f %8d %12.3f %12.3f %14.1f %14.1f" % (os.path.basename(path)[-24:], os.path.getsize(path)/1048576., measurements["reader"][3], \
+      measurements["astropy"][1], measurements["reader"][1], measurements["astropy"][2]/1024., measurements["reader"][2]/1024.)
+    if not args.file:
+      os.remove(path)
+
+def bench_dust(args):
+  """Times E(B-V) lookups in a local SFD map, vectorised and one position at a time, and compares the map with any IRSA DUST responses in a response cache."""
+  dust_map = libned.SFDMap(args.maps)
+  random_state = numpy.random.RandomState(0)
+  lats, lons = random_state.uniform(0, 360, args.positions), numpy.degrees(numpy.arcsin(random_state.uniform(-1, 1, args.positions)))
+  vectorised, wall, vectorised_cpu = timed(dust_map.e_bv, lats, lons)
+  scalar, wall, scalar_cpu = timed(lambda: [dust_map.e_bv(lat, lon) for lat, lon in zip(lats[:1000].tolist(), lons[:1000].tolist())])
+  print "%10s %16s %16s" % ("positions", "vectorised (us)", "scalar (us)")
+  print "%10d %16.2f %16.2f" % (args.positions, vectorised_cpu/args.positions*1e6, scalar_cpu/min(args.positions, 1000)*1e6)
+  if args.cache_dir:
+    comparison = libned.check_dust_map(dust_map, libned.ResponseCache(args.cache_dir).items())
+    print
+    print "%d recorded IRSA DUST responses in %s" % (len(comparison), args.cache_dir)
+    if comparison:
+      lats, lons, means, references, values = (numpy.array(column) for column in zip(*comparison))
+      for name, recorded in (("reference pixel", references), ("mean", means)):
+        differences = numpy.abs(values - recorded)[~numpy.isnan(recorded)]
+        if len(differences):
+          print "%-16s median |difference| %.4f, max %.4f, within 0.001 mag %.1f%%" % (name, numpy.median(differences), differences.max(), 100.*numpy.mean(differences <= 0.001))
+
+def seeded(*key):
+  """Returns a random number generator seeded by a key, so synthetic responses are the same for the same query."""
+  return random.Random(hashlib.md5(repr(key)).hexdigest())
+
+def synthetic_position(name):
+  """Returns the (RA, Dec) that the replay server gives NED for a synthetic source name."""
+  generator = seeded("position", name)
+  return generator.uniform(0, 360), math.degrees(math.asin(generator.uniform(-1, 1)))
+
+def synthetic_catalogue(sources, fields, seed=0):
+  """Builds input lines for a catalogue of synthetic sources with the given input fields.
+     As in real surveys some sources are repeated rows and some names are unknown to NED, leaving their NVSS IDs to be looked up."""
+  generator = random.Random(seed)
+  lines = []
+  for number in xrange(sources):
+    if number and generator.random() < 0.05: # a repeated row
+      lines.append(lines[generator.randrange(len(lines))])
+      continue
+    name = "BENCH %d" % number if generator.random() > 0.03 else "BENCH UNKNOWN %d" % number
+    lat, lon = synthetic_position("NVSS%d" % number if "UNKNOWN" in name else name)
+    values = {"input_lat": "%.5f" % lat, "input_lon": "%.5f" % max(-90, min(90, lon + generator.uniform(-2, 2)/3600)), "ned_name": '"%s"' % name, \
+              "nvss_id": "NVSS%d" % number, "z": "%.4f" % generator.uniform(0.01, 3)}
+    lines.append(" ".join(values.get(field, "%.1f" % generator.uniform(-50, 50)) for field in fields))
+  return lines
+
+def synthetic_ned_position(name):
+  if "UNKNOWN" in name:
+    return "<html><body>No object found</body></html>" # as NED responds, which isn't a votable
+  return votable_text([("pos_ra_equ_J2000_d", "double"), ("pos_dec_equ_J2000_d", "double")], [tuple("%.6f" % value for value in synthetic_position(name))])
+
+synthetic_lock = threading.Lock() # synthetic_ned_sed seeds the shared random generator
+
+def synthetic_ned_sed_response(name):
+  with synthetic_lock:
+    return votable_xml(synthetic_ned_sed(seeded("sed", name).randint(5, 60), seed=int(hashlib.md5(name).hexdigest()[:8], 16)).array.data)
+
+def synthetic_dust(lat, lon):
+  e_bv = seeded("dust", lat, lon).uniform(0.005, 0.3)
+  return '<?xml version="1.0"?>\n<results status="ok"><result><desc>E(B-V) Reddening</desc><statistics>' \
+    '<refPixelValueSandF>%.4f (mag)</refPixelValueSandF><meanValueSandF>%.4f (mag)</meanValueSandF></statistics></result></results>' % (e_bv, e_bv*1.02)
+
+def synthetic_gator_rows(catalog, lat, lon):
+  """Returns the fields and rows of a synthetic Gator cone search, a single nearby object for most positions."""
+  generator = seeded("gator", catalog, "%.5f" % lat, "%.5f" % lon)
+  fields = [("ra", "double"), ("dec", "double")]
+  if catalog == libned.WISE_CATALOG:
+    fields += [("w%dmpro" % band, "double") for band in range(1, 5)] + [("%s_m_2mass" % band, "double") for band in "jhk"]
+  else:
+    fields += [("%s_m" % band, "double") for band in "jhk"]
+  if generator.random() < 0.15:
+    return fields, []
+  row = ["%.7f" % (lat + generator.uniform(-1, 1)/3600), "%.7f" % (lon + generator.uniform(-1, 1)/3600)]
+  row += ["%.3f" % generator.uniform(8, 16) for field in fields[2:]]
+  if catalog == libned.WISE_CATALOG and generator.random() < 0.5: # no 2mass counterpart
+    row[-3:] = [None]*3
+  return fields, [row]
+
+def synthetic_galex(query):
+  """Returns a synthetic GALEX votable for a single or batched SQL query, with a few objects around each position."""
+  fields = [("objid", "long"), ("ra", "double"), ("dec", "double"), ("distance", "double"), ("band", "int"), \
+            ("fuv_mag", "double"), ("nuv_mag", "double"), ("fuv_flux", "double"), ("nuv_flux", "double"), ("e_bv", "double")]
+  batched = "AS source_id" in query
+  rows = []
+  for source_id, lat, lon in re.findall("(?:(\d+) AS source_id.*?)?fGetNearbyObjEq\((-?[0-9.]+), (-?[0-9.]+)", query):
+    generator = seeded("galex", lat, lon)
+    for number in range(generator.randint(0, 3)):
+      rows.append(((int(source_id),) if batched else ()) + (number + 1, "%.7f" % (float(lat) + generator.uniform(-6, 6)/3600), "%.7f" % (float(lon) + generator.uniform(-6, 6)/3600), \
+        generator.uniform(0, 0.2), 3, generator.uniform(18, 24), generator.uniform(18, 24), \
+        "%.3f" % generator.uniform(1, 50) if generator.random() > 0.2 else -999, "%.3f" % generator.uniform(1, 60), "%.4f" % generator.uniform(0.005, 0.1)))
+  return votable_text(([("source_id", "int")] if batched else []) + fields, rows)
+
+GALEX_FORM = '<html><body><form method="post" action="?page=sqlform"><input type="hidden" name="__VIEWSTATE" value="bench"/>' \
+  '<textarea name="_ctl10:QueryTextbox"></textarea><select name="_ctl10:ofmt"><option value="HTML">HTML</option><option value="VOT">VOT</option></select>' \
+  '<input type="submit" name="_ctl10:Submit" value="Submit"/></form></body></html>' # the parts of the GALEX search form that libned uses
+
+def service(url):
+  """Returns the (scheme, host, path) of a URL, which identifies the service it queries."""
+  return urlparse.urlsplit(url)[:3]
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers requests for every service libned queries, as a proxy, after the configured latency.
+     Responses recorded in a response cache are replayed and anything else is answered with synthetic data."""
+  protocol_version = "HTTP/1.1" # keep-alive
+
+  def log_message(self, *args): pass
+
+  def do_GET(self):
+    self.answer(None)
+
+  def do_POST(self):
+    self.answer(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+  def answer(self, body):
+    time.sleep(self.server.latency)
+    url = self.path if "://" in self.path else "http://%s%s" % (self.headers.get("Host"), self.path)
+    try:
+      response, content_type = self.respond(url, body)
+      self.send_response(200)
+    except Exception as e:
+      response, content_type = "Replay server error: %s" % e, "text/plain"
+      self.send_response(500)
+    with self.server.lock:
+      self.server.requests += 1
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(response)))
+    self.end_headers()
+    self.wfile.write(response)
+
+  def respond(self, url, body):
+    """Returns the response to a request and its content type."""
+    fields = []
+    if body is not None and self.headers.get("Content-Type", "").startswith("multipart/form-data"): # gator upload
+      form = cgi.FieldStorage(fp=StringIO.StringIO(body), headers=self.headers, environ={"REQUEST_METHOD": "POST"})
+      fields = [(name, form.getvalue(name)) for name in form.keys()]
+      key = libned.normalise_query(url, urllib.urlencode([(name, value) for name, value in fields if name != "filename"] + [("upload", form.getvalue("filename"))]))
+    elif service(url) == service(libned.GALEX_SEARCH_PAGE) and body is not None: # galex form, cached by its query alone
+      fields = urlparse.parse_qsl(body, keep_blank_values=True)
+      query = dict(fields).get("_ctl10:QueryTextbox", "")
+      key = libned.normalise_query(libned.GALEX_SEARCH_PAGE, urllib.urlencode({"query": query}))
+    else:
+      key = libned.normalise_query(url, body)
+    recorded = self.server.responses.get(key) if self.server.responses else None
+    if recorded is not None:
+      with self.server.lock:
+        self.server.replayed += 1
+    if service(url) == service(libned.GALEX_SEARCH_PAGE):
+      if body is None:
+        return GALEX_FORM, "text/html"
+      name = hashlib.sha1(key).hexdigest()
+      with self.server.lock:
+        self.server.galex_results[name] = recorded if recorded is not None else synthetic_galex(query)
+      return "<html><body><script>window.open('tmp/galex_%s.xml')</script></body></html>" % name, "text/html"
+    match = re.search("galex_(\\w+)\\.xml$", urlparse.urlsplit(url).path)
+    if match:
+      with self.server.lock:
+        return self.server.galex_results.pop(match.group(1)), "text/xml"
+    if recorded is not None:
+      return recorded, "text/xml"
+    parameters = dict(urlparse.parse_qsl(urlparse.urlsplit(url).query))
+    if service(url) == service(libned.NED_POSITION_SEARCH_PATH):
+      return synthetic_ned_position(parameters["objname"]), "text/xml"
+    if service(url) == service(libned.NED_SED_SEARCH_PATH):
+      return synthetic_ned_sed_response(parameters["objname"]), "text/xml"
+    if service(url) == service(libned.DUST_SEARCH_PATH):
+      return synthetic_dust(*map(float, parameters["locstr"].split())), "text/xml"
+    if service(url) == service(libned.GATOR_UPLOAD_PATH) and fields:
+      fields = dict(fields)
+      table_fields, rows = [("source_id_01", "int")], []
+      for line in fields["filename"].splitlines()[2:]: # ipac table rows after the two header lines
+        source_id, lat, lon = line.split()
+        cone_fields, cone_rows = synthetic_gator_rows(fields["catalog"], float(lat), float(lon))
+        table_fields = [("source_id_01", "int")] + cone_fields
+        rows += [[source_id] + row for row in cone_rows]
+      return votable_text(table_fields, rows), "text/xml"
+    if service(url) == service(libned.WISE_SEARCH_PATH): # and 2mass, which is the same service
+      return votable_text(*synthetic_gator_rows(parameters["catalog"], *map(float, parameters["objstr"].split()))), "text/xml"
+    raise ValueError("No service at %s" % url)
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, latency=0., responses=None):
+    BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), ReplayHandler)
+    self.latency = latency # seconds before each response
+    self.responses = responses # a ResponseCache of recorded responses, or None
+    self.galex_results = {} # galex votables by temp file name, as the form's results are fetched separately
+    self.requests = 0
+    self.replayed = 0
+    self.lock = threading.Lock()
+
+def process_usage(pid):
+  """Returns the CPU seconds used so far and peak resident memory (MB) of a running process, from /proc (nan where unavailable)."""
+  try:
+    with open("/proc/%d/stat" % pid) as stat:
+      fields = stat.read().rsplit(")", 1)[1].split()
+    with open("/proc/%d/status" % pid) as status:
+      peak = [int(line.split()[1]) for line in status if line.startswith("VmHWM:")][0]/1024.
+    return (int(fields[11]) + int(fields[12]))/float(os.sysconf("SC_CLK_TCK")), peak
+  except (IOError, OSError, IndexError, ValueError):
+    return float("nan"), float("nan")
+
+def run_pipeline(input_path, ned_args, server, directory):
+  """Runs ned.py on an input file through the replay server and times each of its stages, as announced by its progress output.
+     Returns (stage, wall seconds, CPU seconds, peak memory MB) for each stage and for the whole run."""
+  command = [sys.executable, "-u", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ned.py"), \
+    "--no-cache", "--rate", "0", "--file", os.path.join(directory, "out.dat"), "--plot", directory] + ned_args + [input_path]
+  environment = dict(os.environ, http_proxy="http://127.0.0.1:%d" % server.server_address[1], no_proxy="")
+  start = time.time()
+  process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  boundaries = [("STARTING UP", start, 0., 0.)] # (stage, time, cpu, peak) at the start of each stage
+  for line in iter(process.stdout.readline, ""):
+    if re.match("^[A-Z0-9 ,()-]+\\.\\.\\.$|^RESULTS$|^FINISHED$", line.rstrip("\n")): # stage headers
+      boundaries.append((line.strip().rstrip("."), time.time()) + process_usage(process.pid))
+  pid, status, usage = os.wait4(process.pid, 0)
+  end = (None, time.time(), usage.ru_utime + usage.ru_stime, usage.ru_maxrss/1024.)
+  if status:
+    raise RuntimeError("ned.py failed with status %d" % status)
+  stages = [(stage, next_time - stage_time, next_cpu - cpu, max(peak, next_peak) if next_peak == next_peak else peak) \
+            for (stage, stage_time, cpu, peak), (next_stage, next_time, next_cpu, next_peak) in zip(boundaries, boundaries[1:] + [end])]
+  return stages, ("TOTAL", end[1] - start, end[2], end[3])
+
+def bench_pipeline(args):
+  """Runs the whole ned.py pipeline against a local replay server for synthetic catalogues of increasing size (or an input file),
+     reporting the wall time, throughput, CPU time and peak memory of each stage."""
+  fields = libned.Config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ned.conf")).input_fields
+  server = ReplayServer(args.latency, libned.ResponseCache(args.responses, ttl=float("inf")) if args.responses else None)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  for sources in ([None] if args.input else args.sources):
+    directory = tempfile.mkdtemp()
+    try:
+      input_path = args.input or os.path.join(directory, "input.dat")
+      if not args.input:
+        with open(input_path, "w") as input_file:
+          input_file.write("\n".join(synthetic_catalogue(sources, fields)) + "\n")
+      sources = sources or sum(1 for line in open(input_path) if line.strip() and not line.startswith("#"))
+      requests, replayed = server.requests, server.replayed
+      stages, total = run_pipeline(input_path, args.ned_args, server, directory)
+      print "%d sources, %d requests (%d replayed), %.3fs latency: %s" % (sources, server.requests - requests, server.replayed - replayed, args.latency, " ".join(["ned.py"] + args.ned_args))
+      print "%-56s %10s %10s %12s %10s" % ("stage", "wall (s)", "cpu (s)", "sources/s", "peak (MB)")
+      for stage, wall, cpu, peak in stages + [total]:
+        print "%-56s %10.2f %10.2f %12.1f %10.1f" % (stage[:56], wall, cpu, sources/wall if wall > 0 else float("inf"), peak)
+      print
+    finally:
+      shutil.rmtree(directory)
+  server.shutdown()
+
+HEAVY_MODULES = ("numpy", "astropy", "bs4", "h5py", "pyarrow") # dependencies that are slow to import
+
+def import_time():
+  """Imports libned in a fresh interpreter. Returns the seconds taken by the import and by the whole process, and the heavy modules the import loaded."""
+  code = "import time, sys; start = time.time(); import libned; print time.time() - start, ' '.join(name for name in %r if name in sys.modules)" % (HEAVY_MODULES,)
+  start = time.time()
+  output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+  seconds, modules = (output.strip() + " ").split(" ", 1)
+  return float(seconds), time.time() - start, modules.split()
+
+def configure_worker(pickled_config):
+  """Sets up libned in a worker process from a pickled configuration, as the pool's initializer."""
+  cPickle.loads(pickled_config).apply()
+
+def worker_ready(task):
+  """Returns the worker's process ID once it can parse input."""
+  return os.getpid(), libned.input_regexp is not None
+
+def run_first_result(input_path, server, directory):
+  """Runs ned.py in stream mode on an input file through the replay server. Returns the seconds until its first stage began
+     (interpreter start-up and imports), until the first source's output was written and until it finished."""
+  out_path = os.path.join(directory, "out.dat")
+  command = [sys.executable, "-u", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ned.py"), "--no-cache", "--rate", "0", "--stream", "--file", out_path, input_path]
+  environment = dict(os.environ, http_proxy="http://127.0.0.1:%d" % server.server_address[1], no_proxy="")
+  start = time.time()
+  process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  started = first = None
+  for line in iter(process.stdout.readline, ""):
+    if started is None and line.startswith("READING CONFIGURATION FILE"):
+      started = time.time() - start
+    if first is None and line.endswith(" OUTPUT WRITTEN TO %s\n" % out_path):
+      first = time.time() - start
+  if process.wait():
+    raise RuntimeError("ned.py failed with status %d" % process.returncode)
+  return started, first, time.time() - start
+
+def bench_startup(args):
+  """Measures how quickly libned can start working: importing it, setting up worker processes from a pickled configuration,
+     and running ned.py until its first result against a local replay server."""
+  imports = sorted(import_time() for run in xrange(args.runs))
+  seconds, process_seconds, modules = imports[len(imports)//2]
+  print "import libned: %.3fs (%.3fs for the whole interpreter), median of %d, loading %s" % (seconds, process_seconds, args.runs, ", ".join(modules) or "none of " + ", ".join(HEAVY_MODULES))
+  print
+
+  config = libned.Config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ned.conf"))
+  pickled_config = cPickle.dumps(config, cPickle.HIGHEST_PROTOCOL)
+  wall, cpu = timed(lambda: [configure_worker(pickled_config) for run in xrange(1000)])[1:] # so seconds for 1000 are ms for one
+  print "configuration: %d bytes pickled, %.3fms to unpickle and apply" % (len(pickled_config), wall)
+  print "%-10s %16s" % ("workers", "ready (s)")
+  for workers in args.workers:
+    start = time.time()
+    pool = multiprocessing.Pool(workers, configure_worker, (pickled_config,))
+    ready = pool.map(worker_ready, xrange(4*workers), 1)
+    wall = time.time() - start
+    pool.close()
+    pool.join()
+    assert all(configured for pid, configured in ready)
+    print "%-10d %16.3f" % (workers, wall)
+  print
+
+  server = ReplayServer(args.latency, None)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  directory = tempfile.mkdtemp()
+  try:
+    input_path = os.path.join(directory, "input.dat")
+    with open(input_path, "w") as input_file:
+      input_file.write("\n".join(synthetic_catalogue(args.sources, config.input_fields)) + "\n")
+    runs = [run_first_result(input_path, server, directory) for run in xrange(args.runs)]
+    print "ned.py --stream, %d sources, %.3fs latency, median of %d runs:" % (args.sources, args.latency, args.runs)
+    for name, times in zip(("started up", "first result", "finished"), zip(*runs)):
+      print "  %-14s %8.3fs" % (name, sorted(times)[len(times)//2])
+  finally:
+    shutil.rmtree(directory)
+  server.shutdown()
+
+parser = argparse.ArgumentParser(description="Benchmarks for libned.")
+subparsers = parser.add_subparsers()
+sed_parser = subparsers.add_parser("sed", help="NED SED row filtering against the legacy implementation")
+sed_parser.add_argument("--rows", metavar="N", type=int, nargs="+", default=[100, 1000, 10000, 100000], help="table sizes to benchmark")
+sed_parser.set_defaults(function=bench_sed)
+votable_parser = subparsers.add_parser("votable", help="NED SED votable parsing with astropy against the column-selective reader")
+votable_parser.add_argument("--rows", metavar="N", type=int, nargs="+", default=[1000, 10000, 100000], help="synthetic table sizes to benchmark")
+votable_parser.add_argument("--file", metavar="FILE", nargs="+", help="recorded NED SED votables to benchmark instead of synthetic ones")
+votable_parser.set_defaults(function=bench_votable)
+dust_parser = subparsers.add_parser("dust", help="E(B-V) lookups in a local SFD map, checked against recorded IRSA DUST responses")
+dust_parser.add_argument("--maps", metavar="DIR", required=True, help="directory of the SFD_dust_4096_ngp.fits and SFD_dust_4096_sgp.fits maps")
+dust_parser.add_argument("--positions", metavar="N", type=int, default=100000, help="random positions to look up (default: 100000)")
+dust_parser.add_argument("--cache-dir", metavar="DIR", help="response cache holding recorded IRSA DUST responses to compare with")
+dust_parser.set_defaults(function=bench_dust)
+pipeline_parser = subparsers.add_parser("pipeline", help="the whole ned.py pipeline against a local replay server, stage by stage")
+pipeline_parser.add_argument("--sources", metavar="N", type=int, nargs="+", default=[10, 1000], help="synthetic catalogue sizes to run (default: 10 1000, and try 100000)")
+pipeline_parser.add_argument("--input", metavar="FILE", help="run an input file instead of synthetic catalogues")
+pipeline_parser.add_argument("--responses", metavar="DIR", help="response cache of recorded responses to replay, such as ~/.ned_cache")
+pipeline_parser.add_argument("--latency", metavar="SECONDS", type=float, default=0.05, help="delay before each response (default: 0.05)")
+pipeline_parser.add_argument("ned_args", nargs=argparse.REMAINDER, help="options passed on to ned.py, after --")
+pipeline_parser.set_defaults(function=bench_pipeline)
+startup_parser = subparsers.add_parser("startup", help="import time, worker process set-up and ned.py's latency to its first result")
+startup_parser.add_argument("--runs", metavar="N", type=int, default=5, help="times to repeat each measurement (default: 5)")
+startup_parser.add_argument("--workers", metavar="N", type=int, nargs="+", default=[1, 4, 16], help="worker pool sizes to set up (default: 1 4 16)")
+startup_parser.add_argument("--sources", metavar="N", type=int, default=10, help="synthetic sources for ned.py to run (default: 10)")
+startup_parser.add_argument("--latency", metavar="SECONDS", type=float, default=0., help="delay before each response (default: 0)")
+startup_parser.set_defaults(function=bench_startup)
+
+if __name__ == "__main__":
+  args = parser.parse_args()
+  if getattr(args, "ned_args", None) and args.ned_args[0] == "--":
+    args.ned_args = args.ned_args[1:]
+  args.function(args)
@@ -2,7 +2,8 @@
    the Wide-field Infrared Survey Explorer (WISE) database, the Two Micron All Sky Survey (2MASS) database
    and the Galaxy Evolution Explorer (GALEX) database."""
 
-import urllib, astropy.io.votable, time, warnings, math, mechanize, bs4, re, numpy, xml.etree.ElementTree
+import urllib, httplib, socket, random, email.utils, json, itertools, time, warnings, math, re, numpy, xml.etree.ElementTree, xml.etree.cElementTree, os, errno, hashlib, urlparse, StringIO, threading, thread, sys, cProfile, pstats, datetime, csv, zipfile, tempfile, shutil, gc, heapq, ConfigParser, collections, BaseHTTPServer, SocketServer, abc
+# astropy and bs4 are slow to import and only needed by some runs, so they are imported where they are used
 
 KNOWN_INPUT_FIELDS = {
   "input_lat": "(-?[0-9]+(\.[0-9]+)?)?",
@@ -24,23 +25,79 @@ WISE_SEARCH_PATH = "http://irsa.ipac.caltech.edu/cgi-bin/Gator/nph-query?catalog
 &objstr=%(lat).5f+%(lon).5f"
 TWOMASS_SEARCH_PATH = "http://irsa.ipac.caltech.edu/cgi-bin/Gator/nph-query?catalog=fp_psc&outfmt=3\
 &objstr=%(lat).5f+%(lon).5f"
+NED_SED_EXCLUDED_FIELDS = (\
+  "^line\\b", # word line at start of field
+  "^1983ApJ\\.\\.\\.272\\.\\.400H\\b", # this ref code only at start of field
+  "\\bcount\\s+statistics\\b" # phrase count statistics anywhere in field
+ ) # not allowed patterns in any text field of ned sed output
+NED_SED_EXCLUDED_PASSBANDS = (".?_K20", ".?_14arcsec", ".?_25", ".?_26", "HST", "Spitzer", "ISAAC", "m_p", "CIT", "UKIRT", "GALEX") # not allowed words in ned sed passbands
+NED_SED_SDSS_PASSBAND = re.compile("(^|\s)\(SDSS\\b", re.IGNORECASE) # in passband matches sdss at start of field or after whitespace
+NED_SED_ALLOWED_SDSS_PASSBAND = re.compile("(^|\s)\(SDSS\\b(?!\s+PSF\)(\s|$))", re.IGNORECASE) # in passband matches anything (including nothing) except for psf after sdss
+
+NED_POSITION_COLUMNS = ("pos_ra_equ_J2000_d", "pos_dec_equ_J2000_d") # the only columns of each response used by the parsers
+NED_SED_COLUMNS = ("Frequency", "NED Photometry Measurement", "Observed Passband") # plus all text columns for the filter rules
+WISE_COLUMNS = ("ra", "dec", "w1mpro", "w2mpro", "w3mpro", "w4mpro", "j_m_2mass", "h_m_2mass", "k_m_2mass")
+TWOMASS_COLUMNS = ("ra", "dec", "j_m", "h_m", "k_m")
+GALEX_COLUMNS = ("ra", "dec", "fuv_flux", "nuv_flux", "e_bv")
+
+GATOR_UPLOAD_PATH = "http://irsa.ipac.caltech.edu/cgi-bin/Gator/nph-query" # multi-object queries are POSTed here with an uploaded position table
+GATOR_UPLOAD_ID_COLUMN = "source_id_01" # gator returns the uploaded columns with an _01 suffix
+WISE_CATALOG = "wise_allsky_4band_p3as_psd"
+TWOMASS_CATALOG = "fp_psc"
 GALEX_SEARCH_PAGE = "http://galex.stsci.edu/GR6/?page=sqlform"
 GALEX_SQL_QUERY = "SELECT TOP 100 p.objid, p.ra, p.dec, n.distance, p.band, p.fuv_mag, p.nuv_mag, p.fuv_flux, p.nuv_flux, p.e_bv \
 FROM PhotoObjAll AS p, dbo.fGetNearbyObjEq(%(lat).5f, %(lon).5f, 0.2) AS n \
 WHERE p.objID=n.objID \
 ORDER BY n.distance ASC, p.fuv_mag ASC, p.nuv_mag ASC, p.e_bv ASC"
+GALEX_BATCH_SQL_QUERY = "SELECT * FROM (%(subqueries)s) AS q ORDER BY source_id ASC, distance ASC, fuv_mag ASC, nuv_mag ASC, e_bv ASC"
+GALEX_BATCH_SQL_SUBQUERY = "SELECT TOP 100 %(source_id)d AS source_id, p.objid, p.ra, p.dec, n.distance, p.band, p.fuv_mag, p.nuv_mag, p.fuv_flux, p.nuv_flux, p.e_bv \
+FROM PhotoObjAll AS p, dbo.fGetNearbyObjEq(%(lat).5f, %(lon).5f, 0.2) AS n \
+WHERE p.objID=n.objID \
+ORDER BY n.distance ASC, p.fuv_mag ASC, p.nuv_mag ASC, p.e_bv ASC" # one per source, tagged by its id
+GALEX_MAX_BATCH = 100 # keeps batched SQL queries to a size the search form accepts
 
 O_M = 0.27 # mass density parameter
 O_Lambda = 0.73 # dark energy density parameter
 H_0 = 71 # hubble constant
+WISE_FREQUENCIES = (8.856e+13, 6.445e+13, 2.675e+13, 1.346e+13) # W1 to W4
+TWOMASS_FREQUENCIES = (2.429e14, 1.805e14, 1.390e14) # J, H and K
+GALEX_FREQUENCIES = (1.963e15, 1.321e15) # FUV and NUV
+WISE_ZERO_POINTS = (306.682, 170.663, 29.045, 8.284) # Jy, W1 to W4
+TWOMASS_ZERO_POINTS = (1594., 1024., 667.) # Jy, J, H and K
+
+LOCAL_CONE_RADII = {"wise": 10., "twomass": 10., "galex": 12.} # arcseconds, as searched by the remote services
+LOCAL_MAX_ROWS = {"galex": 100} # as returned by the remote services
+LOCAL_ZONE_HEIGHT = 60. # arcseconds, declination height of the zones of a local catalogue's index
+
 c = 299793000 # speed of light
 R_V = 3.1 # extinction factor
+Z_STEP = 1e-4 # redshift resolution of the tabulated comoving distance integral
+Z_MAX_TABULATED = 20. # highest redshift of the tabulated comoving distance integral, beyond which it is integrated for each redshift
+Z_BEYOND_STEPS = 2048 # steps in log(1+z) of the integral from Z_MAX_TABULATED to each higher redshift
+h = 6.62606957e-34 # planck constant
+UV_FIT_RANGE = (10**14.8, 1e17) # lowest and highest uv frequencies of the power law fits, as in plot.sh
+LOWEST_IONISATION_FREQUENCY = 3.29e15
+UV_FIT_TABLE = "uv_fits.txt" # summary of the uv fits, written to the plot directory
+
+cache = None # on-disk response cache, disabled unless set to a ResponseCache
+checkpoint = None # journal of completed processing stages, disabled unless set to a Checkpoint
+backends = {} # local data used instead of the remote services, by stage: LocalCatalogues for "wise", "twomass" or "galex" and an SFDMap for "dust"
+galex_form = None # the GALEX search form's default fields, fetched once
+comoving_integrals = {} # tabulated comoving distance integrals by (O_M, O_Lambda)
+luminosity_distances = {} # by (z, O_M, O_Lambda, H_0)
+galex_form_lock = threading.Lock()
+downloads = {} # downloads in progress by normalised query key, shared by concurrent requests for the same key
+downloads_lock = threading.Lock()
+requests_saved = 0 # requests avoided by coalescing duplicate queries
 
-class DataPoint:
-  """A storage class for frequency vs flux data from various sources"""
+class DataPoint(object):
+  """A storage class for frequency vs flux data from various sources.
+     Only point-specific values are stored; any other output field is looked up on the source the point refers to."""
   repr_format_string = ""
+  __slots__ = ("_source", "index", "num", "freq", "flux", "data_source", "flag", "lat", "lon", "offset_from_ned", "extinction", "name")
 
   def __init__(self, source, data): # source refers to the source the data point is describing
+    self._source = source
     # initialise point-specific default values with correct types for output string
     self.index = -1
     self.num = -1
@@ -54,18 +111,23 @@ class DataPoint:
     self.extinction = 1. # default extinction value for all sources?
 
     [setattr(self, *entry) for entry in data.items()] # set proper values
-    [setattr(self, key, value) for key, value in vars(source).items() if key not in vars(self)] # set any missing values with their source-wide defaults
-    self.name = self.name.replace(" ","") # remove spaces to make output easier to parse
+    self.name = source.name.replace(" ","") # remove spaces to make output easier to parse
+
+  def __getitem__(self, key):
+    """Returns the value of an output field, from the point if it is point-specific otherwise from its source."""
+    if key in self.__slots__ and key != "_source":
+      return getattr(self, key)
+    return vars(self._source)[key]
 
   def __repr__(self):
     """Formats the frequency vs flux data for a space-separated .dat file given a user-specified format string."""
-    return self.repr_format_string % vars(self) # only includes instance variables
+    return self.repr_format_string % self # looks up fields by name
 
 class Source:
   """Instances of this class represent extragalactic objects."""
   tolerance = 10. # global 10 arcsecond position offset tolerance
 
-  def __init__(self, line):
+  def __init__(self, line, data=None, index=None): # data is the line's parsed data, if already parsed
     # common for all data points for this source, can be overwritten by user-specified fields
     self.ned_name = None
     self.nvss_id = None
@@ -73,7 +135,7 @@ class Source:
     self.input_lat = float("inf")
     self.input_lon = float("inf")
 
-    [setattr(self, *entry) for entry in parse_line(line).items()] # set provided values
+    [setattr(self, *entry) for entry in (parse_line(line) if data is None else data).items()] # set provided values
     [setattr(self, input_field, "") for input_field in input_fields if not hasattr(self, input_field)] # set unspecified input strings to the empty string
     self.input_lat = float(self.input_lat) # fix up types
     self.input_lon = float(self.input_lon) # fix up types
@@ -83,6 +145,7 @@ class Source:
     # common for all data points for this source, will overwrite any clashing user-specified fields
     self.points = []
     self.line = line # raw input specifying source
+    self.index = index # position among all of the input's sources, counted from 1
     self.ned_position = None
     self.dust = None
     self.ned_sed = None
@@ -90,43 +153,101 @@ class Source:
     self.twomass = None
     self.galex = None
     self.search_name = None
+    self.position_download_failed = False # whether fetching the NED position failed for either name
     self.ned_lat = float("inf")
     self.ned_lon = float("inf")
     self.input_offset_from_ned = float("inf")
     self.e_bv = float("inf")
+    self.completed_stages = set() # names of the processing stages done, see Checkpoint.STAGES
 
     print "  Recognised source:", self.name
 
   def __repr__(self):
     return "\n".join(map(repr, self.points))
 
+  def rest_frame_luminosities(self):
+    """Returns arrays of the rest-frame frequencies (Hz) and luminosities (W/Hz) of the source's data points."""
+    freqs, fluxes, extinctions = (numpy.array([getattr(point, name) for point in self.points], dtype=float) for name in ("freq", "flux", "extinction"))
+    return (1+self.z)*freqs, luminosities(fluxes, extinctions, self.z)
+
   def plot_output(self):
     """Builds and formats output for plotting by a utility such as gnuplot."""
-    # we need to calculate the total line-of-sight comoving distance for this redshift
-    # D_C = c/H_0 * integral [0, z] dz/E(z)
-    # first we calculate the integral
-    # E(z) = sqrt( O_M(1+z)^3 + O_k(1+z)^2 + O_Lambda )
-    O_k = 1 - O_M - O_Lambda
-    num_intervals = 10000 # fineness of integration
-    partition = (x*self.z/num_intervals for x in xrange(num_intervals))
+    format_strings = {"NED": "%.5e 0 0 0", "WISE": "0 %.5e 0 0", "2MASS": "0 0 %.5e 0", "GALEX": "0 0 0 %.5e"}
+    return "freq NED WISE 2MASS GALEX\n" + "\n".join("%.5e " % freq + format_strings[point.data_source] % luminosity for point, freq, luminosity in zip(self.points, *(array.tolist() for array in self.rest_frame_luminosities())))
 
-    E = lambda z: math.sqrt(O_M*(1+z)**3 + O_k*(1+z)**2 + O_Lambda)
-    I = numpy.trapz([1/x for x in map(E, partition) if x is not 0.], dx=self.z/num_intervals)
-    D_C = (c/1000)/H_0 * I # c in km/s
+  def process(self, index):
+    """Fetches and parses all of the source's data in dependency order, skipping any stages restored from the checkpoint,
+       and then releases the raw downloads. Returns the source."""
+    self.resume(index)
+    if "position" not in self.completed_stages:
+      self.get_and_parse_ned_position()
+      self.complete("position", index)
+    if "dust" not in self.completed_stages:
+      self.dust = self.get_dust_xml()
+      self.parse_dust()
+      self.complete("dust", index)
+    if "ned_sed" not in self.completed_stages:
+      self.ned_sed = self.get_ned_sed_votable()
+      self.parse_ned_sed(index)
+      self.complete("ned_sed", index)
+    if "wise" not in self.completed_stages:
+      self.wise = self.get_wise_votable()
+      self.parse_wise(index) # including any 2mass data
+      self.complete("wise", index)
+    if "twomass" not in self.completed_stages:
+      if not self.twomass:
+        self.twomass = self.get_twomass_votable()
+      self.parse_twomass(index)
+      self.complete("twomass", index)
+    if "galex" not in self.completed_stages:
+      self.galex = self.get_galex_votable()
+      self.parse_galex(index)
+      self.complete("galex", index)
+    self.release()
+    return self
 
-    # assuming a flat universe the transverse comoving distance equals the radial comoving distance
-    D_M = D_C
+  def resume(self, index):
+    """Restores the state of any stages of processing the checkpoint has journaled for the source."""
+    if checkpoint:
+      stages = checkpoint.restore(index, self)
+      metrics.advance(len(stages))
+      for stage in stages:
+        metrics.count("sources", stage, restored=1)
+      if stages:
+        print "  Restored from checkpoint (%s): %s" % (", ".join(stages), self.name)
 
-    # the luminosity distance is given by D_L = (1+z)D_M (in units of Mpc)
-    D_L = (1+self.z)*D_M
+  def complete(self, stage, index):
+    """Marks a stage of processing as done and journals its results if checkpointing.
+       A stage whose download failed is left undone so that resuming retries it."""
+    metrics.advance()
+    if self.download_failed(stage):
+      metrics.count("sources", stage, failed=1)
+      return
+    metrics.count("sources", stage, completed=1)
+    self.completed_stages.add(stage)
+    if checkpoint:
+      checkpoint.record(index, self, stage)
 
-    # converting to units of metres
-    d_l = 3.086e22*D_L
+  def download_failed(self, stage):
+    """Returns whether the download for a stage failed even though the source had what the download depends on."""
+    if stage == "position": # NED not recognising either name is an answer, not a failure
+      return self.position_download_failed
+    if stage == "ned_sed":
+      return self.ned_sed is None and not not self.search_name
+    return getattr(self, stage) is None and self.has_search_position()
 
-    # now we generate the plot output
-    luminosity = lambda flux, extinction: 4*math.pi*(d_l**2)*flux*extinction*1e-26/(1+self.z)
-    format_strings = {"NED": "%.5e 0 0 0", "WISE": "0 %.5e 0 0", "2MASS": "0 0 %.5e 0", "GALEX": "0 0 0 %.5e"}
-    return "freq NED WISE 2MASS GALEX\n" + "\n".join("%.5e " % ((1+self.z)*point.freq) + format_strings[point.data_source] % luminosity(point.flux, point.extinction) for point in self.points)
+  def release(self):
+    """Drops the raw downloaded data, which is no longer needed once it has been parsed into data points."""
+    for name in ("ned_position", "dust", "ned_sed", "wise", "twomass", "galex"):
+      setattr(self, name, None)
+
+  def has_search_position(self):
+    """Returns whether the source has usable search coordinates."""
+    try:
+      int(self.search_lat()) + int(self.search_lon()) # will error if inf or nan
+      return True
+    except:
+      return False
 
   def search_lat(self):
     """Returns the NED latitude if it exists, otherwise returns the input-provided latitude."""
@@ -151,12 +272,20 @@ class Source:
     for search_name in (self.ned_name, self.nvss_id): # determine which name alternative between ned name and nvss id should be used
       if not search_name: # try the other name if this one isn't specified
         continue
-      self.ned_position = get_votable(NED_POSITION_SEARCH_PATH % urllib.quote_plus(search_name))
+      url = NED_POSITION_SEARCH_PATH % urllib.quote_plus(search_name)
+      print " ", url
       try:
+        data = fetch(url)
+      except:
+        print "  Could not download data from %s. You may not be connected to the Internet." % url
+        self.position_download_failed = True # unlike NED not recognising the name, worth retrying
+        continue # try again using nvss id
+      try:
+        self.ned_position = parse_votable(data, NED_POSITION_COLUMNS)
         for key, name in (("ned_lat", "pos_ra_equ_J2000_d"), ("ned_lon", "pos_dec_equ_J2000_d")):
           setattr(self, key, float(self.ned_position.array[name].data.item()))
         self.search_name = search_name # will be set if above is successful
-        self.input_offset_from_ned = math.hypot(self.ned_lat-self.input_lat, self.ned_lon-self.input_lon)*3600 # will be set if above is successful
+        self.input_offset_from_ned = self.ned_offsets(self.input_lat, self.input_lon).item() # will be set if above is successful
         print "  Found NED position data:", self.name
         return # don't continue with the loop
       except:
@@ -169,12 +298,14 @@ class Source:
       int(self.search_lat()) + int(self.search_lon()) # will error if inf or nan
     except:
       return # don't try downloading if no coordinates are known
+    if "dust" in backends:
+      return float(backends["dust"].e_bv(self.search_lat(), self.search_lon())) # looked up in a local map instead
     try:
       url = DUST_SEARCH_PATH % {"lat": self.search_lat(), "lon": self.search_lon()}
       print " ", url
-      xml_file = urllib.urlopen(url) # grab xml file-like-object from the web
-      time.sleep(1) # respect request throttling recommendations
-      return xml.etree.ElementTree.parse(xml_file) # parse xml
+      data = fetch(url)
+      with metrics.timer("parsing", "xml"):
+        return xml.etree.ElementTree.parse(StringIO.StringIO(data)) # parse xml
     except:
       print "  Could not download or interpret data from %s. You may not be connected to the Internet or the input data contains unrecognised names or coordinates." % url
     return
@@ -183,7 +314,7 @@ class Source:
     """Builds the correct URL and fetches the source's NED SED votable.
        Depends on NED name or NVSS ID."""
     if self.search_name: # check if ned recognises the provided ned name
-      return get_votable(NED_SED_SEARCH_PATH % urllib.quote_plus(self.search_name))
+      return get_votable(NED_SED_SEARCH_PATH % urllib.quote_plus(self.search_name), NED_SED_COLUMNS, text_columns=True)
     return
 
   def get_wise_votable(self):
@@ -191,7 +322,9 @@ class Source:
        Depends on position."""
     try:
       int(self.search_lat()) + int(self.search_lon()) # will error if inf or nan
-      return get_votable(WISE_SEARCH_PATH % {"lat": self.search_lat(), "lon": self.search_lon()})
+      if "wise" in backends:
+        return backends["wise"].cone(self.search_lat(), self.search_lon(), WISE_COLUMNS)
+      return get_votable(WISE_SEARCH_PATH % {"lat": self.search_lat(), "lon": self.search_lon()}, WISE_COLUMNS)
     except: return
 
   def get_twomass_votable(self):
@@ -199,57 +332,38 @@ class Source:
        Depends on position."""
     try:
       int(self.search_lat()) + int(self.search_lon()) # will error if inf or nan
-      return get_votable(TWOMASS_SEARCH_PATH % {"lat": self.search_lat(), "lon": self.search_lon()})
+      if "twomass" in backends:
+        return backends["twomass"].cone(self.search_lat(), self.search_lon(), TWOMASS_COLUMNS)
+      return get_votable(TWOMASS_SEARCH_PATH % {"lat": self.search_lat(), "lon": self.search_lon()}, TWOMASS_COLUMNS)
     except: return
 
   def get_galex_votable(self):
-    """Browses to the GALEX search page, sets the output format to votable and the correct SQL query,
-       submits the form and finds the output xml which is then parsed to astropy votable and returned.
+    """Builds the correct SQL query and fetches the source's GALEX votable from the GALEX search page (or the response cache).
        Depends on position."""
     try:
       int(self.search_lat()) + int(self.search_lon()) # will error if inf or nan
     except: return
     try:
-      browser = mechanize.Browser()
-      browser.open(GALEX_SEARCH_PAGE)
-      browser.select_form(nr=0) # assume only one form on the page
-
-      browser.form["_ctl10:QueryTextbox"] = GALEX_SQL_QUERY % {"lat": self.search_lat(), "lon": self.search_lon()}
-      browser.form["_ctl10:ofmt"] = ["VOT"] # set the output to votable xml
-
-      response = browser.submit() # send off the modified form
-      time.sleep(1) # respect request throttling recommendations
-
-      html = bs4.BeautifulSoup(response.get_data()) # read data into html parser
-      browser.close()
-
-      popup_js = html.find("script", text=re.compile("^window.open\('tmp\/galex_\S+\.xml'\)$")).find(text=True) # returns the content of the script tag
-      url = "http://galex.stsci.edu/GR6/" + re.compile("tmp\/galex_\S+\.xml").search(popup_js).group() # grabs the temp file name and constructs the url
-
-      return get_votable(url)
+      if "galex" in backends:
+        return backends["galex"].cone(self.search_lat(), self.search_lon(), GALEX_COLUMNS)
+      query = GALEX_SQL_QUERY % {"lat": self.search_lat(), "lon": self.search_lon()}
+      return parse_votable(cached(normalise_query(GALEX_SEARCH_PAGE, urllib.urlencode({"query": query})), lambda: query_galex(query)), GALEX_COLUMNS)
     except:
       print "  Could not download or interpret data from %s. You may not be connected to the Internet or the input data contains unrecognised NED names." % GALEX_SEARCH_PAGE
 
   def parse_dust(self):
-    """Picks out the E(B-V) reddening value and records it."""
+    """Picks out the E(B-V) reddening value (unless it was looked up in a local map) and records it."""
     try:
-      e_bv_result_node = filter(lambda node: node.find("desc").text.strip() == "E(B-V) Reddening", self.dust.findall("./result[desc]"))[0]
-      self.e_bv = float(re.compile("^(?P<e_bv>[0-9]+(\.[0-9]+)?)\s*\(mag\)$", re.IGNORECASE).match(e_bv_result_node.find("statistics/meanValueSandF").text.strip()).groupdict()["e_bv"])
+      self.e_bv = self.dust if isinstance(self.dust, float) else dust_e_bv(self.dust)
       print "  Found extinction data:", self.name
     except:
       print "  Can't find extinction data:", self.name
 
   def parse_ned_sed(self, index):
     """Picks out the frequency vs flux data and records them as data points."""
-    all_fields_filter_regexp = re.compile(""" # for finding not allowed patterns in all fields of ned sed output
-      ^line\\b # word line at start of field
-      |
-      ^1983ApJ\.\.\.272\.\.400H\\b # this ref code only at start of field
-      |
-      \\bcount\s+statistics\\b # phrase count statistics anywhere in field
-      """, re.VERBOSE | re.IGNORECASE)
-
     try:
+      keep = filter_ned_sed(self.ned_sed.array)
+      freqs = numpy.asarray(self.ned_sed.array["Frequency"].data, dtype=float)[keep]
       [self.points.append(DataPoint(self, {\
          "index": index, \
          "num": len(self.points)+1, \
@@ -259,166 +373,153 @@ class Source:
          "lat": self.ned_lat, \
          "lon": self.ned_lon, \
          "offset_from_ned": 0., \
-         "extinction": e_bv_to_extinction(self.e_bv, freq)\
+         "extinction": extinction\
         })) \
-       for freq, flux, line, passband \
+       for freq, flux, extinction \
        in zip(\
-         map(float, self.ned_sed.array["Frequency"].data.tolist()), \
-         map(float, self.ned_sed.array["NED Photometry Measurement"].data.tolist()), \
-         (map(str, line) for line in self.ned_sed.array.tolist()), \
-         map(str, self.ned_sed.array["Observed Passband"].data.tolist())\
-        ) \
-       if \
-         True not in (not not all_fields_filter_regexp.search(entry) for entry in line) \
-         and (\
-           re.search("(^|\s)\(SDSS\\b(?!\s+PSF\)(\s|$)) # in passband matches anything (including nothing) except for psf after sdss", passband, re.VERBOSE | re.IGNORECASE) \
-           if re.search("(^|\s)\(SDSS\\b # in passband matches sdss at start of field or after whitespace", passband, re.VERBOSE | re.IGNORECASE) \
-           else not re.search(""" # search passband for various not allowed patterns
-             \\b(
-             .?_K20
-             |
-             .?_14arcsec
-             |
-             .?_25
-             |
-             .?_26
-             |
-             HST
-             |
-             Spitzer
-             |
-             ISAAC
-             |
-             m_p
-             |
-             CIT
-             |
-             UKIRT
-             |
-             GALEX
-             )\\b
-             """, passband, re.VERBOSE | re.IGNORECASE)\
-          ) \
-         and not math.isnan(flux) \
-         and flux > 0 \
-         and not math.isnan(freq) \
-         and freq > 0\
+         freqs.tolist(), \
+         numpy.asarray(self.ned_sed.array["NED Photometry Measurement"].data, dtype=float)[keep].tolist(), \
+         e_bv_to_extinctions(self.e_bv, freqs).tolist() # all rows at once\
+        )\
       ].pop() # pop to trigger error if list empty
       print "  Found NED SED data:", self.name
     except:
       print "  Can't find NED SED data:", self.name
 
   def parse_wise(self, index):
-    """Picks out the frequency vs flux data and records them as data points."""
-    try: # see if 2mass data is included
-      [int(self.wise.array[name].data.item()) for name in ("%s_m_2mass" % letter for letter in ("j", "h", "k"))]  # will error if no 2mass data
-      self.twomass = self.wise # if gets to here then 2mass is included in wise
-    except: pass # will try to fetch 2mass later
+    """Picks out the frequency vs flux data of the nearest WISE row within tolerance and records them as data points.
+       If that row has all of its 2MASS magnitudes they are used as the 2MASS data."""
     try:
-      wise_lat = float(self.wise.array["ra"].data.item())
-      wise_lon = float(self.wise.array["dec"].data.item())
-      wise_offset = math.hypot(self.ned_lat-wise_lat, self.ned_lon-wise_lon)*3600
-      [self.points.append(DataPoint(self, {\
-         "index": index, \
-         "num": len(self.points)+1, \
-         "freq": freq, \
-         "flux": flux, \
-         "data_source": "WISE", \
-         "lat": wise_lat, \
-         "lon": wise_lon, \
-         "offset_from_ned": wise_offset, \
-         "extinction": e_bv_to_extinction(self.e_bv, freq)\
-        })) \
-       for freq, flux \
-       in zip(\
-         (8.856e+13, 6.445e+13, 2.675e+13, 1.346e+13), \
-         map(float.__mul__, (306.682, 170.663, 29.045, 8.284), (10**(-.4*float(self.wise.array["w%dmpro" % number].data.item())) for number in range(1,5)))\
-        ) \
-       if math.hypot(self.search_lat()-wise_lat, self.search_lon()-wise_lon)*3600 <= self.tolerance and not math.isnan(flux) and flux > 0\
-      ]
+      row = crossmatch(self.wise, self.search_lat(), self.search_lon(), self.tolerance)
+    except:
+      print "  Can't find WISE data:", self.name
+      return
+    twomass_columns = ["%s_m_2mass" % letter for letter in ("j", "h", "k")] # optional, otherwise will try to fetch 2mass later
+    if len(row) and all(name in self.wise.array.dtype.names for name in twomass_columns) \
+       and numpy.isfinite(table_columns(self.wise, twomass_columns, row)).all():
+      self.twomass = self.wise # will be crossmatched again, to the same row
+    try:
+      self.add_band_points(self.wise, row, "WISE", WISE_FREQUENCIES, ["w%dmpro" % number for number in range(1,5)], WISE_ZERO_POINTS, index)
       print "  Found WISE data:", self.name
     except:
       print "  Can't find WISE data:", self.name
 
   def parse_twomass(self, index):
-    """Picks out the frequency vs flux data and records them as data points."""
+    """Picks out the frequency vs flux data of the nearest 2MASS row within tolerance and records them as data points."""
     try:
-      twomass_lat = float(self.twomass.array["ra"].data.item())
-      twomass_lon = float(self.twomass.array["dec"].data.item())
-      twomass_offset = math.hypot(self.ned_lat-twomass_lat, self.ned_lon-twomass_lon)*3600
-      [self.points.append(DataPoint(self, {\
-         "index": index, \
-         "num": len(self.points)+1, \
-         "freq": freq, \
-         "flux": flux, \
-         "data_source": "2MASS", \
-         "lat": twomass_lat, \
-         "lon": twomass_lon, \
-         "offset_from_ned": twomass_offset, \
-         "extinction": e_bv_to_extinction(self.e_bv, freq)\
-        })) \
-       for freq, flux \
-       in zip(\
-         (2.429e14, 1.805e14, 1.390e14), \
-         map(float.__mul__, (1594., 1024., 667.), (10**(-.4*float(self.twomass.array["%c_m" % letter + "_2mass"*(self.twomass==self.wise)].data.item())) for letter in ("j", "h", "k")))\
-        ) \
-       if math.hypot(self.search_lat()-twomass_lat, self.search_lon()-twomass_lon)*3600 <= self.tolerance and not math.isnan(flux) and flux > 0\
-      ]
+      row = crossmatch(self.twomass, self.search_lat(), self.search_lon(), self.tolerance)
+      self.add_band_points(self.twomass, row, "2MASS", TWOMASS_FREQUENCIES, ["%s_m" % letter + "_2mass"*(self.twomass is self.wise) for letter in ("j", "h", "k")], TWOMASS_ZERO_POINTS, index)
       print "  Found 2MASS data:", self.name
     except:
       print "  Can't find 2MASS data:", self.name
 
+  def add_band_points(self, table, row, data_source, freqs, magnitude_columns, zero_points, index):
+    """Records a data point for each band of a crossmatched catalogue row with a valid flux, converting the row's magnitudes
+       to fluxes for all of the bands at once. Errors if there is no row."""
+    lat, lon = table_columns(table, ("ra", "dec"), row)[0].tolist() # errors if no row
+    offset = self.ned_offsets(lat, lon).item()
+    [self.points.append(DataPoint(self, {\
+       "index": index, \
+       "num": len(self.points)+1, \
+       "freq": freq, \
+       "flux": flux, \
+       "data_source": data_source, \
+       "lat": lat, \
+       "lon": lon, \
+       "offset_from_ned": offset, \
+       "extinction": band_extinction(self.e_bv, freq)\
+      })) \
+     for freq, flux \
+     in zip(freqs, magnitudes_to_fluxes(table_columns(table, magnitude_columns, row), zero_points)[0].tolist()) \
+     if not math.isnan(flux) and flux > 0\
+    ]
+
   def parse_galex(self, index):
-    """Picks out the frequency vs flux data and records them as data points."""
+    """Averages the GALEX rows within tolerance, band by band over the rows with a valid flux and E(B-V),
+       and records the averages as data points, flagged if more than one row was returned."""
     try:
-      galex_lats = map(float, self.galex.array["ra"].data.tolist())
-      galex_lons = map(float, self.galex.array["dec"].data.tolist())
-      galex_offsets_from_ned = [offset*3600 for offset in map(math.hypot, (self.search_lat()-lat for lat in galex_lats), (self.search_lon()-lon for lon in galex_lons))]
-
-      mean_filter = lambda (lat, lon, offset, flux, e_bv): offset <= self.tolerance and not math.isnan(flux) and flux > 0 and not math.isnan(e_bv) and e_bv > 0 # -999 indicates no data
-
-      for freq, flux_name in zip((1.963e15, 1.321e15), ("fuv_flux", "nuv_flux")):
-        galex_averages = dict(\
-          (key, numpy.mean(value)) \
-          for key, value \
-          in zip(\
-            ("lat", "lon", "offset", "flux", "e_bv"), \
-            zip(*filter(\
-              mean_filter, \
-              zip(\
-                galex_lats, \
-                galex_lons, \
-                galex_offsets_from_ned, \
-                map(float, self.galex.array[flux_name].data.tolist()), \
-                map(float, self.galex.array["e_bv"].data.tolist())\
-               )\
-             ))\
-           )\
-         ) # only wanted data remains
-
-        try:
-          self.points.append(DataPoint(self, {\
-            key: value for key, value in (\
-              ("index", index), \
-              ("num", len(self.points)+1), \
-              ("freq", freq), \
-              ("flux", galex_averages["flux"]/1e6), \
-              ("data_source", "GALEX"), \
-              ("flag", 'm'*(not not len(galex_offsets_from_ned) > 1)), \
-              ("lat", galex_averages["lat"]), \
-              ("lon", galex_averages["lon"]), \
-              ("offset_from_ned", math.hypot(self.ned_lat-galex_averages["lat"], self.ned_lon-galex_averages["lon"])*3600), \
-              ("extinction", e_bv_to_extinction(galex_averages["e_bv"], freq))
-             )
-            if not (key == "flag" and not value)\
-           })) # don't include flag if not changed from default
-        except: pass # keep going with the loop
-
-      galex_offsets_from_ned.pop() # will error if empty
+      rows = crossmatch(self.galex, self.search_lat(), self.search_lon(), self.tolerance, nearest=False)
+      lats, lons, e_bvs = table_columns(self.galex, ("ra", "dec", "e_bv"), rows).T
+      fluxes = table_columns(self.galex, ("fuv_flux", "nuv_flux"), rows)
+      with numpy.errstate(invalid="ignore"): # nan is never valid
+        valid = (fluxes > 0) & (e_bvs > 0)[:, numpy.newaxis] # -999 indicates no data
+      for band, freq in enumerate(GALEX_FREQUENCIES):
+        averaged = valid[:, band]
+        if not averaged.any():
+          continue
+        lat, lon, flux, e_bv = (float(numpy.mean(values[averaged])) for values in (lats, lons, fluxes[:, band], e_bvs))
+        self.points.append(DataPoint(self, {\
+          key: value for key, value in (\
+            ("index", index), \
+            ("num", len(self.points)+1), \
+            ("freq", freq), \
+            ("flux", flux/1e6), \
+            ("data_source", "GALEX"), \
+            ("flag", 'm'*(len(self.galex.array) > 1)), \
+            ("lat", lat), \
+            ("lon", lon), \
+            ("offset_from_ned", self.ned_offsets(lat, lon).item()), \
+            ("extinction", band_extinction(e_bv, freq))
+           )
+          if not (key == "flag" and not value)\
+         })) # don't include flag if not changed from default
+      1/len(self.galex.array) # errors if no rows were returned
       print "  Found GALEX data:", self.name # successfully found at least some data
     except:
       print "  Can't find GALEX data:", self.name
 
+  def ned_offsets(self, lats, lons):
+    """Returns the angular separations (arcseconds) of positions from the NED position, which are inf if it is unknown."""
+    with numpy.errstate(invalid="ignore"):
+      separations = angular_separations(self.ned_lat, self.ned_lon, lats, lons)
+    return numpy.where(numpy.isnan(separations), numpy.inf, separations)
+
+def table_columns(table, names, rows):
+  """Returns the values of the named columns of a table for the given rows as an array of floats, one column per name."""
+  return numpy.column_stack([numpy.asarray(table.array[name].data, dtype=float)[rows] for name in names])
+
+def crossmatch(table, lat, lon, tolerance, nearest=True):
+  """Matches the rows of a table of catalogue data to a position (decimal degrees), computing the angular separations of all of its rows
+     (ra and dec columns) at once. Returns the numbers of the rows within tolerance (arcseconds): just the nearest one if nearest is set,
+     otherwise all of them in table order."""
+  with numpy.errstate(invalid="ignore"):
+    separations = angular_separations(lat, lon, *table_columns(table, ("ra", "dec"), slice(None)).T)
+    rows = numpy.flatnonzero(separations <= tolerance) # nan positions never match
+  if nearest and len(rows):
+    return rows[[numpy.argmin(separations[rows])]]
+  return rows
+
+def magnitudes_to_fluxes(magnitudes, zero_points):
+  """Converts an array of magnitudes, a column per band, to fluxes (Jy) given each band's zero point flux (Jy)."""
+  return numpy.asarray(zero_points, dtype=float)*10**(-.4*magnitudes)
+
+def compile_ned_sed_filters(excluded_fields=NED_SED_EXCLUDED_FIELDS, excluded_passbands=NED_SED_EXCLUDED_PASSBANDS):
+  """Compiles the rules for rejecting rows of NED SED data: a row is rejected if any of its text fields matches one of the
+     excluded field patterns, or if its passband isn't SDSS and contains one of the excluded passband patterns as a word."""
+  return re.compile("|".join(excluded_fields) or "(?!)", re.IGNORECASE), re.compile("\\b(%s)\\b" % "|".join(excluded_passbands) if excluded_passbands else "(?!)", re.IGNORECASE) # (?!) never matches
+
+ned_sed_filters = compile_ned_sed_filters() # compiled once for all sources
+
+def distinct_verdicts(test, values):
+  """Applies a test once to each distinct value in a sequence and returns the results for every value as a boolean array."""
+  verdicts = dict((value, not not test(value)) for value in set(values))
+  return numpy.fromiter((verdicts[value] for value in values), dtype=bool, count=len(values))
+
+def filter_ned_sed(array):
+  """Returns a mask of the rows of a NED SED votable array which pass the filter rules and have positive frequencies and fluxes.
+     Rules are evaluated column by column, once per distinct value."""
+  fields_regexp, passbands_regexp = ned_sed_filters
+  keep = numpy.ones(len(array), dtype=bool)
+  with metrics.timer("filtering", "ned_sed"):
+    for name in array.dtype.names:
+      if array[name].dtype.kind in "OSU": # numbers can't match text rules
+        keep &= ~distinct_verdicts(fields_regexp.search, map(str, array[name].tolist()))
+    keep &= distinct_verdicts(lambda passband: NED_SED_ALLOWED_SDSS_PASSBAND.search(passband) if NED_SED_SDSS_PASSBAND.search(passband) else not passbands_regexp.search(passband), \
+      map(str, array["Observed Passband"].data.tolist()))
+  with numpy.errstate(invalid="ignore"): # nan compares false
+    keep &= (numpy.asarray(array["NED Photometry Measurement"].data, dtype=float) > 0) & (numpy.asarray(array["Frequency"].data, dtype=float) > 0)
+  return keep
+
 def build_input_regexp():
   """Given the input string build a regexp to match against valid lines of data input."""
   quotation_mark_match_names = {}
@@ -452,15 +553,1701 @@ def parse_line(line):
     return {key: value for key, value in input_regexp.match(line.strip()).groupdict().items() if value and (key in input_fields)} # errors if no match, filters blanks
   except: return # skip line
 
-def get_votable(url):
-  """Fetches from the web and returns data for a source, in an astropy votable."""
+def input_validators():
+  """Returns tests equivalent to the input regexp's patterns for the values of the input fields: (number, test) for each
+     known field with a restricted pattern, and the numbers of the fields (other than names) whose quoted values can't contain whitespace."""
+  tests = [(number, re.compile("(?:%s)$" % KNOWN_INPUT_FIELDS[field], re.IGNORECASE).match) for number, field in enumerate(input_fields) if KNOWN_INPUT_FIELDS.get(field, ".*?") != ".*?"]
+  single_tokens = [number for number, field in enumerate(input_fields) if KNOWN_INPUT_FIELDS.get(field) != ".*?"]
+  return tests, single_tokens
+
+class Config:
+  """The configuration of a run as given in ned.conf: the input fields, the output format string, the NED SED filter rules and
+     the local catalogues and maps to search instead of the remote services. It holds only plain values, so it is cheap to pickle
+     and send to worker processes, each of which then sets up the library from it with apply()."""
+
+  def __init__(self, input_fields, output_format, excluded_fields=NED_SED_EXCLUDED_FIELDS, excluded_passbands=NED_SED_EXCLUDED_PASSBANDS, backends=()):
+    self.input_fields = list(input_fields)
+    self.output_format = output_format
+    self.excluded_fields = tuple(excluded_fields)
+    self.excluded_passbands = tuple(excluded_passbands)
+    self.backends = dict(backends) # (path, search radius) by stage, or (directory, scaling) for "dust"
+
+  @classmethod
+  def read(cls, path="ned.conf"):
+    """Reads a configuration file in the format of ned.conf."""
+    config = ConfigParser.RawConfigParser()
+    config.read(path)
+    backends = {}
+    if config.has_option("Backends", "dust"):
+      backends["dust"] = (os.path.expanduser(config.get("Backends", "dust")), config.getfloat("Backends", "dust_scaling") if config.has_option("Backends", "dust_scaling") else 0.86)
+    for stage in ("wise", "twomass", "galex"):
+      if config.has_option("Backends", stage):
+        backends[stage] = (os.path.expanduser(config.get("Backends", stage)), config.getfloat("Backends", "%s_radius" % stage) if config.has_option("Backends", "%s_radius" % stage) else LOCAL_CONE_RADII[stage])
+    return cls(\
+      config.get("Format", "input").strip().split(), \
+      config.get("Format", "output"), \
+      [pattern.strip() for pattern in config.get("Filters", "excluded_fields").split("\n") if pattern.strip()] if config.has_option("Filters", "excluded_fields") else NED_SED_EXCLUDED_FIELDS, \
+      config.get("Filters", "excluded_passbands").split() if config.has_option("Filters", "excluded_passbands") else NED_SED_EXCLUDED_PASSBANDS, \
+      backends\
+     )
+
+  def validate(self):
+    """Raises a ValueError if the output format string uses anything but the output fields and the input fields."""
+    placeholders = {int: -1, float: float("inf"), str: "a"}
+    values = dict((name, "") for name in self.input_fields)
+    values.update((name, placeholders[kind]) for name, kind in OUTPUT_FIELDS)
+    try:
+      self.output_format % values
+    except:
+      raise ValueError("Mismatch between output and input fields. Check ned.conf.")
+
+  def apply(self):
+    """Sets up the library in this process: the input fields and regexp, the output format, the NED SED filters and the local backends."""
+    global input_fields, input_regexp, ned_sed_filters
+    input_fields = list(self.input_fields)
+    input_regexp = build_input_regexp()
+    DataPoint.repr_format_string = self.output_format
+    ned_sed_filters = compile_ned_sed_filters(self.excluded_fields, self.excluded_passbands)
+    backends.clear()
+    for stage, (path, parameter) in sorted(self.backends.items()):
+      backends[stage] = SFDMap(path, parameter) if stage == "dust" else LocalCatalogue(path, parameter, LOCAL_MAX_ROWS.get(stage))
+
+def split_line(line, (tests, single_tokens)):
+  """Parses the data on a line of input by splitting it into a value per field, without the input regexp.
+     Returns None for lines which don't split into exactly one valid value per field, which need the full input regexp."""
+  if '"' not in line:
+    values = line.split()
+    if len(values) != len(input_fields):
+      return
+    for number, test in tests:
+      if not test(values[number]):
+        return
+    return dict(zip(input_fields, values))
+  parts = line.strip().split('"') # alternately unquoted and quoted
+  last = len(parts) - 1
+  if last % 2: # unbalanced quotation marks
+    return
+  values = []
+  quoted = set() # numbers of the quoted values
+  for number, part in enumerate(parts):
+    if number % 2:
+      quoted.add(len(values))
+      values.append(part)
+      continue
+    if (number and not (part[:1].isspace() or not part and number == last)) or (number < last and not (part[-1:].isspace() or not part and not number)):
+      return # quotation marks must be separated from other values by whitespace
+    values.extend(part.split())
+  if len(values) != len(input_fields):
+    return
+  for number, test in tests:
+    if not test(values[number]):
+      return
+  for number in quoted.intersection(single_tokens):
+    if values[number].split() != [values[number]] and values[number]:
+      return
+  return dict((field, value) for field, value in zip(input_fields, values) if value)
+
+def read_input(lines, delimiter=None):
+  """Parses each line of input exactly once, yielding the (line, data) of the lines with data, lazily.
+     Lines are split without the input regexp where possible, falling back to it for lines (such as those with unquoted
+     multi-word names) which can't be split. Given a delimiter, lines are instead parsed as delimited values (e.g. CSV)."""
+  validators = input_validators()
+  for line in lines:
+    if line.startswith("#"):
+      continue
+    if delimiter:
+      values = [value.strip() for value in next(csv.reader([line], delimiter=delimiter))] if line.strip() else []
+      if len(values) != len(input_fields) or not all(test(values[number]) for number, test in validators[0]):
+        continue
+      data = dict((field, value) for field, value in zip(input_fields, values) if value)
+    else:
+      data = split_line(line, validators)
+      if data is None:
+        data = parse_line(line)
+    if data:
+      yield line, data
+
+def read_sources(lines, delimiter=None, shard=None):
+  """Yields a Source for each line of input with data (in a shard, if given), lazily, indexed by its position among all of the input's sources."""
+  for index, (line, data) in enumerate(read_input(lines, delimiter), 1):
+    if shard is None:
+      yield Source(line, data, index)
+      continue
+    shard.total = index
+    if line in shard:
+      yield Source(line, data, index)
+
+def load_sources(lines, delimiter=None, shard=None):
+  """Returns a list of a Source for each line of input with data (in a shard, if given). The cyclic garbage collector is paused
+     meanwhile, since the many long-lived objects being created would otherwise trigger repeated full collections."""
+  enabled = gc.isenabled()
+  gc.disable()
+  try:
+    return list(read_sources(lines, delimiter, shard))
+  finally:
+    if enabled:
+      gc.enable()
+
+class Shard:
+  """One of a number of shards of the input, numbered from 1. Input lines are assigned to shards by a hash of the line,
+     so every line belongs to the same shard whichever process or machine reads the input."""
+
+  def __init__(self, number, count):
+    if not 1 <= number <= count:
+      raise ValueError("Shard %d of %d doesn't exist" % (number, count))
+    self.number = number
+    self.count = count
+    self.total = 0 # sources read from the whole input so far, in any shard
+
+  def __contains__(self, line):
+    return int(hashlib.md5(line.rstrip("\r\n")).hexdigest()[:8], 16) % self.count == self.number - 1
+
+  def __str__(self):
+    return "%d/%d" % (self.number, self.count)
+
+def parse_shard(text):
+  """Returns the Shard given as "I/N"."""
+  number, count = map(int, text.split("/"))
+  return Shard(number, count)
+
+class ShardIndex:
+  """The sidecar of a shard's output, saved alongside it as <output>.shard, which records the global index of each
+     of the shard's sources with the byte range of its text output and the name of any plot file written for it,
+     so that the outputs of all of the shards can be merged into the output of a single run."""
+
+  def __init__(self, output_path, shard, output_format, plot_dir=None):
+    self.path = output_path + ".shard"
+    self.shard = shard
+    self.output_format = output_format
+    self.plot_dir = os.path.relpath(plot_dir, os.path.dirname(os.path.abspath(output_path))) if plot_dir else None # relative to the sidecar, so shards can be moved
+    self.sources = [] # [index, start, end, plot file name] of each source, in output order
+    self.entries = {} # the same by index
+
+  def add(self, source, start=None, end=None):
+    """Records a source's output, given its byte range in text output."""
+    self.entries[source.index] = [source.index, start, end, None]
+    self.sources.append(self.entries[source.index])
+
+  def add_plot(self, source, name):
+    """Records the name of the plot file written for a source."""
+    self.entries[source.index][3] = name
+
+  def save(self):
+    """Saves the sidecar, once the whole input has been read."""
+    temp_path = "%s.%d.tmp" % (self.path, os.getpid())
+    with open(temp_path, "w") as sidecar:
+      json.dump({"shard": [self.shard.number, self.shard.count], "format": self.output_format, "plot_dir": self.plot_dir, "total": self.shard.total, "sources": self.sources}, sidecar)
+    os.rename(temp_path, self.path) # never leave a partial sidecar, which would make a failed shard look complete
+
+def merge_shards(paths, output, plot_dir=None, row_group_size=65536):
+  """Merges the outputs of every shard of a run (and their plot files, into a plot directory if given) in input order,
+     giving the same output as a single run. Returns the number of sources merged."""
+  sidecars = []
+  for path in paths:
+    try:
+      with open(path + ".shard") as sidecar:
+        sidecars.append(json.load(sidecar))
+    except IOError:
+      raise ValueError("%s has no sidecar; it isn't the complete output of a shard" % path)
+  counts, totals, formats = (set(value) for value in zip(*[(sidecar["shard"][1], sidecar["total"], sidecar["format"]) for sidecar in sidecars]))
+  if len(counts) != 1 or len(totals) != 1 or len(formats) != 1:
+    raise ValueError("The outputs are from different runs (shard counts, input sizes or formats differ)")
+  numbers = sorted(sidecar["shard"][0] for sidecar in sidecars)
+  if numbers != range(1, counts.pop() + 1):
+    raise ValueError("Every shard's output is needed exactly once, but got shards %s" % ", ".join(map(str, numbers)))
+  indexes = sorted(entry[0] for sidecar in sidecars for entry in sidecar["sources"])
+  if indexes != range(1, totals.pop() + 1):
+    raise ValueError("The shards' sources don't cover the input exactly once")
+  for path, sidecar in zip(paths, sidecars): # plot directories are recorded relative to the shard's output, wherever it now is
+    if sidecar["plot_dir"] is not None:
+      sidecar["plot_dir"] = os.path.join(os.path.dirname(os.path.abspath(path)), sidecar["plot_dir"])
+  output_format = formats.pop()
+  if output_format == "text":
+    files = [open(path, "rb") for path in paths]
+    for index, start, end, plot_name, shard_file in heapq.merge(*[[entry + [shard_file] for entry in sidecar["sources"]] for sidecar, shard_file in zip(sidecars, files)]):
+      shard_file.seek(start)
+      output.write(shard_file.read(end - start))
+    [shard_file.close() for shard_file in files]
+  else:
+    fields, columns = zip(*[read_point_table(path, output_format) for path in paths])
+    columns = [numpy.concatenate(column) for column in zip(*columns)]
+    order = numpy.argsort(numpy.asarray(columns[[name for name, kind in fields[0]].index("index")], dtype=numpy.int64), kind="mergesort") # stable, so each source's points stay in order
+    if output_format == "csv":
+      writer = csv.writer(output)
+      writer.writerow([name for name, kind in fields[0]])
+      writer.writerows(zip(*[column[order].tolist() for column in columns]))
+    else:
+      writer = {"npz": NPZPointWriter, "hdf5": HDF5PointWriter, "parquet": ParquetPointWriter}[output_format](output, fields[0], row_group_size)
+      for start in xrange(0, len(order), row_group_size):
+        writer.write_group([column[order[start:start+row_group_size]] for column in columns])
+      writer.finish()
+  if plot_dir:
+    winners = {} # plot files by name, from the last source writing each, as in a single run
+    for sidecar in sidecars:
+      for index, start, end, plot_name in sidecar["sources"]:
+        if plot_name and winners.get(plot_name, (0,))[0] < index:
+          winners[plot_name] = (index, sidecar["plot_dir"])
+    for plot_name, (index, shard_plot_dir) in sorted(winners.items()):
+      shutil.copyfile(os.path.join(shard_plot_dir, plot_name), os.path.join(plot_dir, plot_name))
+    tables = [os.path.join(sidecar["plot_dir"], UV_FIT_TABLE) for sidecar in sidecars]
+    if all(os.path.exists(table) for table in tables):
+      write_uv_fit_table(os.path.join(plot_dir, UV_FIT_TABLE), [line.rstrip("\n") for table in tables for line in list(open(table))[1:]])
+  return len(indexes)
+
+def read_point_table(path, output_format):
+  """Reads a table of data points written in a columnar format. Returns its (name, type) fields and columns.
+     CSV values are kept as the text written, so that they can be written again unchanged."""
+  if output_format == "csv":
+    with open(path, "rb") as table:
+      rows = list(csv.reader(table))
+    columns = [numpy.array(values, dtype=object) for values in zip(*rows[1:])] if len(rows) > 1 else [numpy.array([], dtype=object) for name in rows[0]]
+    return [(name, str) for name in rows[0]], columns
+  if output_format == "npz":
+    table = numpy.load(path)
+    names = table.files # in the order written
+    columns = [table[name] for name in names]
+  elif output_format == "hdf5":
+    import h5py # optional, only needed for hdf5 output
+    with h5py.File(path, "r") as table:
+      names = json.loads(table.attrs["fields"])
+      columns = [table[name][:] for name in names]
+  else:
+    import pyarrow.parquet # optional, only needed for parquet output
+    table = pyarrow.parquet.read_table(path)
+    names = table.schema.names
+    columns = [numpy.array(table.column(name).to_pylist(), dtype=object if str(field.type) == "string" else None) for name, field in zip(names, table.schema)]
+  kinds = {"i": int, "f": float}
+  return [(name, kinds.get(column.dtype.kind, str)) for name, column in zip(names, columns)], columns
+
+OUTPUT_FIELDS = (\
+  ("index", int), \
+  ("name", str), \
+  ("ned_name", str), \
+  ("nvss_id", str), \
+  ("search_name", str), \
+  ("z", float), \
+  ("num", int), \
+  ("freq", float), \
+  ("flux", float), \
+  ("data_source", str), \
+  ("flag", str), \
+  ("lat", float), \
+  ("lon", float), \
+  ("ned_lat", float), \
+  ("ned_lon", float), \
+  ("input_lat", float), \
+  ("input_lon", float), \
+  ("offset_from_ned", float), \
+  ("input_offset_from_ned", float), \
+  ("e_bv", float), \
+  ("extinction", float)\
+ ) # (name, type) of every output field a data point has, before any custom input fields (which are strings)
+OUTPUT_FORMATS = ("text", "csv", "npz", "hdf5", "parquet")
+
+def output_fields():
+  """Returns the (name, type) of every output field, including the custom input fields."""
+  names = set(name for name, kind in OUTPUT_FIELDS)
+  return list(OUTPUT_FIELDS) + [(name, str) for name in input_fields if name not in names]
+
+def open_point_writer(output_format, output, row_group_size=65536):
+  """Returns a PointWriter which writes data points in a columnar format ("csv", "npz", "hdf5" or "parquet") to an output file."""
+  writers = {"csv": CSVPointWriter, "npz": NPZPointWriter, "hdf5": HDF5PointWriter, "parquet": ParquetPointWriter}
+  return writers[output_format](output, output_fields(), row_group_size)
+
+class PointWriter(object):
+  """Writes the data points of sources as a table with a column per output field, in bulk a row group at a time,
+     so that output doesn't have to be formatted as text and parsed again. Subclasses write the row groups in a format."""
+  __metaclass__ = abc.ABCMeta
+
+  def __init__(self, output, fields, row_group_size=65536):
+    self.output = output # a file-like object
+    self.fields = fields # (name, type) of each column
+    self.row_group_size = row_group_size # rows buffered before they are written
+    self.sources = [] # sources whose points are buffered
+    self.rows = 0 # points buffered
+
+  def write(self, source):
+    """Buffers a source's data points, writing a row group once enough have been buffered."""
+    if source.points:
+      self.sources.append(source)
+      self.rows += len(source.points)
+    if self.rows >= self.row_group_size:
+      self.flush()
+
+  def flush(self):
+    """Writes the buffered points as a row group."""
+    if self.rows:
+      self.write_group(self.columns())
+    self.sources = []
+    self.rows = 0
+
+  def close(self):
+    """Writes any buffered points and finishes the output."""
+    self.flush()
+    self.finish()
+
+  def columns(self):
+    """Returns the buffered points' values of each field as arrays, in field order.
+       Point-specific values come from the points and any other values from their sources, as for the text output."""
+    columns = []
+    for name, kind in self.fields:
+      if name in DataPoint.__slots__:
+        values = [getattr(point, name) for source in self.sources for point in source.points]
+      else:
+        values = list(itertools.chain.from_iterable(itertools.repeat(vars(source)[name], len(source.points)) for source in self.sources))
+      if kind is str:
+        columns.append(numpy.array(["" if value is None else str(value) for value in values], dtype=str))
+      else:
+        columns.append(numpy.array(values, dtype=numpy.int64 if kind is int else float))
+    return columns
+
+  @abc.abstractmethod
+  def write_group(self, columns):
+    """Writes a row group given the values of each field as arrays, in field order."""
+
+  def finish(self):
+    """Finishes the output once every row group has been written."""
+
+class CSVPointWriter(PointWriter):
+  """Writes data points as comma-separated values with a header row, floats being written exactly."""
+
+  def __init__(self, output, fields, row_group_size=65536):
+    PointWriter.__init__(self, output, fields, row_group_size)
+    self.writer = csv.writer(output)
+    self.writer.writerow([name for name, kind in fields])
+
+  def write_group(self, columns):
+    self.writer.writerows(zip(*[map(repr, column.tolist()) if column.dtype.kind == "f" else column.tolist() for column in columns]))
+
+class NPZPointWriter(PointWriter):
+  """Writes data points as a NumPy .npz archive of a .npy array per column, as numpy.savez does.
+     Each row group is saved to a temporary file until the archive is written at the end, so that string columns
+     can be given the width of their longest value without holding the whole table in memory."""
+
+  def __init__(self, output, fields, row_group_size=65536):
+    PointWriter.__init__(self, output, fields, row_group_size)
+    self.directory = tempfile.mkdtemp()
+    self.groups = 0
+
+  def write_group(self, columns):
+    for (name, kind), column in zip(self.fields, columns):
+      numpy.save(os.path.join(self.directory, "%s.%d.npy" % (name, self.groups)), column)
+    self.groups += 1
+
+  def finish(self):
+    try:
+      with zipfile.ZipFile(self.output, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name, kind in self.fields:
+          groups = [os.path.join(self.directory, "%s.%d.npy" % (name, group)) for group in xrange(self.groups)]
+          headers = [numpy.load(path, mmap_mode="r") for path in groups]
+          dtype = reduce(numpy.promote_types, (group.dtype for group in headers), numpy.dtype(str if kind is str else numpy.int64 if kind is int else float))
+          path = os.path.join(self.directory, "%s.npy" % name)
+          with open(path, "wb") as column:
+            numpy.lib.format.write_array_header_1_0(column, {"descr": numpy.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (sum(len(group) for group in headers),)})
+            for group in headers:
+              numpy.asarray(group, dtype=dtype).tofile(column)
+          del headers
+          archive.write(path, "%s.npy" % name)
+          [os.remove(path) for path in groups + [path]]
+    finally:
+      shutil.rmtree(self.directory)
+
+class HDF5PointWriter(PointWriter):
+  """Writes data points as an HDF5 file of a resizable dataset per column, extended by each row group. Needs h5py."""
+
+  def __init__(self, output, fields, row_group_size=65536):
+    PointWriter.__init__(self, output, fields, row_group_size)
+    try:
+      import h5py # optional, only needed for hdf5 output
+    except ImportError:
+      raise ImportError("h5py is needed to write HDF5 output")
+    self.file = h5py.File(getattr(output, "name", output), "w") # by name, as h5py can't write to python 2 file objects
+    self.file.attrs["fields"] = json.dumps([name for name, kind in fields]) # datasets are listed alphabetically
+    self.datasets = [self.file.create_dataset(name, shape=(0,), maxshape=(None,), chunks=True, \
+      dtype=h5py.special_dtype(vlen=str) if kind is str else numpy.int64 if kind is int else float) for name, kind in fields]
+
+  def write_group(self, columns):
+    for dataset, column in zip(self.datasets, columns):
+      dataset.resize((len(dataset) + len(column),))
+      dataset[-len(column):] = column
+
+  def finish(self):
+    self.file.close()
+
+class ParquetPointWriter(PointWriter):
+  """Writes data points as a Parquet file with a Parquet row group per row group. Needs pyarrow."""
+
+  def __init__(self, output, fields, row_group_size=65536):
+    PointWriter.__init__(self, output, fields, row_group_size)
+    try:
+      import pyarrow, pyarrow.parquet # optional, only needed for parquet output
+    except ImportError:
+      raise ImportError("pyarrow is needed to write Parquet output")
+    self.pyarrow = pyarrow
+    self.schema = pyarrow.schema([(name, pyarrow.string() if kind is str else pyarrow.int64() if kind is int else pyarrow.float64()) for name, kind in fields])
+    self.writer = pyarrow.parquet.ParquetWriter(output, self.schema)
+
+  def write_group(self, columns):
+    arrays = [self.pyarrow.array(column.tolist() if column.dtype.kind == "S" else column, type=field.type) for field, column in zip(self.schema, columns)]
+    self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+  def finish(self):
+    self.writer.close()
+
+class TableRows:
+  """A selection of the rows of a votable, providing the same array interface to the parsers as the votable itself."""
+
+  def __init__(self, table, rows):
+    self.array = table.array[rows]
+
+class ResponseCache:
+  """An on-disk store of raw responses addressed by a hash of their normalised query.
+     Entries expire after ttl seconds and the least recently used entries are evicted once max_size bytes are exceeded."""
+
+  def __init__(self, directory, ttl=30*24*3600, max_size=1024*1024*1024, refresh=False):
+    self.directory = directory
+    self.ttl = ttl
+    self.max_size = max_size
+    self.refresh = refresh # ignore existing entries but store fresh ones
+    self.lock = threading.Lock() # guards the running size total between fetching threads
+    try:
+      os.makedirs(directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST: raise
+    self.size = sum(os.path.getsize(path) for path in self.entries()) # running total, saves rescanning on every store
+
+  def entries(self):
+    """Returns the paths of all entries in the cache."""
+    return [os.path.join(root, name) for root, dirs, names in os.walk(self.directory) for name in names if not name.endswith(".tmp")]
+
+  def path(self, key):
+    """Returns the content-addressed path of the entry for a key."""
+    digest = hashlib.sha1(key).hexdigest()
+    return os.path.join(self.directory, digest[:2], digest[2:])
+
+  def get(self, key):
+    """Returns the cached response for a key, or None if it is missing, expired or being refreshed."""
+    if self.refresh:
+      return
+    path = self.path(key)
+    try:
+      with open(path, "rb") as entry:
+        created, entry_key = entry.readline().rstrip("\n").split(" ", 1) # header line records creation time and key
+        if entry_key != key: # hash collision
+          return
+        if time.time() - float(created) > self.ttl: # expired
+          self.remove(path)
+          return
+        data = entry.read()
+      os.utime(path, None) # modification time records last use for eviction
+      return data
+    except (IOError, OSError, ValueError):
+      return
+
+  def put(self, key, data):
+    """Stores a response for a key, evicting the least recently used entries if the cache is too large."""
+    path = self.path(key)
+    try:
+      os.makedirs(os.path.dirname(path))
+    except OSError as e:
+      if e.errno != errno.EEXIST: raise
+    temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), thread.get_ident()) # unique per writer
+    with open(temp_path, "wb") as entry:
+      entry.write("%.6f %s\n" % (time.time(), key))
+      entry.write(data)
+    with self.lock:
+      if os.path.exists(path):
+        self.size -= os.path.getsize(path)
+      os.rename(temp_path, path) # atomic so readers never see a partial entry
+      self.size += os.path.getsize(path)
+      if self.size > self.max_size:
+        self.evict()
+
+  def items(self):
+    """Yields the key and response of every unexpired entry in the cache."""
+    for path in self.entries():
+      try:
+        with open(path, "rb") as entry:
+          created, key = entry.readline().rstrip("\n").split(" ", 1)
+          if time.time() - float(created) <= self.ttl:
+            yield key, entry.read()
+      except (IOError, ValueError): pass
+
+  def remove(self, path):
+    """Deletes an entry."""
+    try:
+      size = os.path.getsize(path)
+      os.remove(path)
+      self.size -= size
+    except OSError: pass
+
+  def evict(self):
+    """Deletes the least recently used entries until the cache is at most three quarters full."""
+    for mtime, path in sorted((os.path.getmtime(path), path) for path in self.entries()):
+      if self.size <= 0.75*self.max_size:
+        break
+      self.remove(path)
+
+class Checkpoint:
+  """An append-only journal of the state each source reaches at each stage of processing, one JSON record per line,
+     synced to disk as it is written so that an interrupted run can be resumed without repeating completed work."""
+
+  STAGES = ("position", "dust", "ned_sed", "wise", "twomass", "galex") # in processing order
+  STAGE_FIELDS = {"position": ("ned_lat", "ned_lon", "search_name", "input_offset_from_ned"), "dust": ("e_bv",)} # source attributes set by each stage, besides data points
+  POINT_FIELDS = ("index", "num", "freq", "flux", "data_source", "flag", "lat", "lon", "offset_from_ned", "extinction")
+
+  def __init__(self, path, resume=False):
+    self.path = path
+    self.states = {} # journaled records by source key and stage
+    self.point_counts = {} # number of each source's data points journaled or restored so far
+    self.lock = threading.Lock() # serialises writes from fetching threads
+    if resume and os.path.exists(path):
+      with open(path, "r+b") as journal:
+        data = journal.read()
+        data = data[:data.rfind("\n")+1]
+        journal.truncate(len(data)) # drop any record torn by a crash
+      for line in data.splitlines():
+        record = json.loads(line)
+        self.states.setdefault(record["key"], {})[record["stage"]] = record # later records supersede earlier ones
+    self.journal = open(path, "ab" if resume else "wb")
+
+  def key(self, index, source):
+    """Returns the key identifying a source's records: its position in the input and its input line."""
+    return u"%d %s" % (index, source.line.rstrip("\r\n").decode("utf-8", "replace"))
+
+  def record(self, index, source, stage):
+    """Journals the attributes a stage has set on a source and the data points it has added."""
+    key = self.key(index, source)
+    with self.lock:
+      first_point = self.point_counts.get(key, 0)
+      self.point_counts[key] = len(source.points)
+      state = dict((name, getattr(source, name)) for name in self.STAGE_FIELDS.get(stage, ()))
+      if stage == "wise":
+        state["twomass_included"] = source.twomass is not None and source.twomass is source.wise
+      self.journal.write(json.dumps({"key": key, "stage": stage, "state": state, \
+        "points": [[getattr(point, name) for name in self.POINT_FIELDS] for point in source.points[first_point:]]}) + "\n")
+      self.journal.flush()
+      os.fsync(self.journal.fileno())
+      if stage == self.STAGES[-1]: # nothing more to journal for this source
+        del self.point_counts[key]
+
+  def restore(self, index, source):
+    """Restores the journaled state of a source for each stage in order up to the first incomplete one.
+       WISE data which included the 2MASS data is only restored along with the 2MASS stage. Returns the stages restored."""
+    key = self.key(index, source)
+    records = self.states.pop(key, {})
+    restored = []
+    for stage in self.STAGES:
+      record = records.get(stage)
+      if record is None or (stage == "wise" and record["state"].get("twomass_included") and "twomass" not in records):
+        break
+      for name in self.STAGE_FIELDS.get(stage, ()):
+        setattr(source, name, from_json(record["state"][name]))
+      source.points.extend(DataPoint(source, dict(zip(self.POINT_FIELDS, map(from_json, values)))) for values in record["points"])
+      source.completed_stages.add(stage)
+      restored.append(stage)
+    if len(restored) < len(self.STAGES): # more to journal
+      with self.lock:
+        self.point_counts[key] = len(source.points)
+    return restored
+
+  def close(self):
+    self.journal.close()
+
+def from_json(value):
+  """Converts a value read from JSON back to the type used by sources, where strings are byte strings."""
+  return value.encode("utf-8") if isinstance(value, unicode) else value
+
+class Metrics:
+  """Records where a run's time goes: the wall and CPU time of each stage of the run, and counters and timings (requests, bytes,
+     failures, cache hits, parsing time, data points and so on) grouped by section and then by key, such as by host.
+     Also tracks progress through the run's units of work and collects cProfile profiles of any profiled threads.
+     Safe to share between fetching threads."""
+
+  def __init__(self):
+    self.start = time.time()
+    self.stages = [] # [name, start time, start CPU time, wall seconds, CPU seconds] of each stage of the run, in order
+    self.sections = {} # counters by section, then key, then name
+    self.total = None # units of work in the run, if known, for estimating the time remaining
+    self.done = 0 # units of work done
+    self.work_start = None # time the first unit of work was done
+    self.profiles = [] # cProfile profiles of the profiled threads
+    self.finished = threading.Event() # stops progress reports
+    self.lock = threading.Lock()
+
+  def stage(self, name):
+    """Ends the current stage of the run, if any, and starts timing the named one."""
+    now, cpu = time.time(), sum(os.times()[:2])
+    with self.lock:
+      self.end_stage(now, cpu)
+      self.stages.append([name, now, cpu, None, None])
+
+  def end_stage(self, now, cpu):
+    if self.stages and self.stages[-1][3] is None:
+      self.stages[-1][3:] = [now - self.stages[-1][1], cpu - self.stages[-1][2]]
+
+  def count(self, section, key, **amounts):
+    """Adds amounts to the named counters of a key in a section, e.g. count("hosts", host, requests=1, seconds=0.2)."""
+    with self.lock:
+      counters = self.sections.setdefault(section, {}).setdefault(key, {})
+      for name, amount in amounts.iteritems():
+        counters[name] = counters.get(name, 0) + amount
+
+  def timer(self, section, key):
+    """Returns a context manager which counts the calls and seconds spent in a block of code under a key in a section."""
+    return Timer(self, section, key)
+
+  def advance(self, units=1):
+    """Records that units of work have been done."""
+    with self.lock:
+      self.done += units
+      if self.work_start is None:
+        self.work_start = time.time()
+
+  def progress(self):
+    """Returns a line describing the work done so far and, if the amount of work is known, an estimate of the time remaining."""
+    with self.lock:
+      done, total, elapsed = self.done, self.total, time.time() - (self.work_start or time.time())
+    rate = done/elapsed if elapsed > 0 else 0.
+    line = "  Progress: %d%s stages done, %.1f per second" % (done, "/%d (%.0f%%)" % (total, 100.*done/total) if total else "", rate)
+    if total and rate > 0:
+      line += ", about %s remaining" % datetime.timedelta(seconds=int(max(total - done, 0)/rate))
+    return line
+
+  def report_progress(self, interval):
+    """Prints the progress of the run every interval seconds, in the background, until the run finishes."""
+    def report():
+      while not self.finished.wait(interval):
+        print self.progress()
+    reporter = threading.Thread(target=report)
+    reporter.daemon = True
+    reporter.start()
+
+  def profile(self):
+    """Starts profiling the calling thread, e.g. as a thread pool initializer."""
+    profile = cProfile.Profile()
+    with self.lock:
+      self.profiles.append(profile)
+    profile.enable()
+
+  def hot_paths(self, limit=25):
+    """Returns the functions which took the most cumulative and the most internal time over all of the profiled threads,
+       which should have finished (or be idle) by now."""
+    stats = pstats.Stats(*self.profiles).stats # (file, line, function) -> (primitive calls, calls, internal seconds, cumulative seconds, callers)
+    entries = [{"function": "%s:%d(%s)" % function, "calls": calls, "primitive_calls": primitive_calls, "internal_seconds": internal, "cumulative_seconds": cumulative} \
+               for function, (primitive_calls, calls, internal, cumulative, callers) in stats.iteritems()]
+    return {\
+      "cumulative": sorted(entries, key=lambda entry: -entry["cumulative_seconds"])[:limit], \
+      "internal": sorted(entries, key=lambda entry: -entry["internal_seconds"])[:limit]\
+     }
+
+  def summary(self):
+    """Ends the run's current stage and progress reports, and returns everything recorded as a dict ready to be written as JSON."""
+    self.finished.set()
+    now, cpu = time.time(), sum(os.times()[:2])
+    with self.lock:
+      self.end_stage(now, cpu)
+      summary = {\
+        "elapsed_seconds": now - self.start, \
+        "cpu_seconds": cpu, \
+        "stages": [{"name": name, "wall_seconds": wall, "cpu_seconds": stage_cpu} for name, start, start_cpu, wall, stage_cpu in self.stages], \
+        "progress": {"done": self.done, "total": self.total}, \
+        "requests_saved": requests_saved\
+       }
+    summary.update(self.counters())
+    if self.profiles:
+      summary["profile"] = self.hot_paths()
+    return summary
+
+  def counters(self):
+    """Returns a copy of the counters and timings recorded so far, by section and then by key."""
+    with self.lock:
+      return json.loads(json.dumps(self.sections))
+
+class Timer:
+  """Counts the calls and seconds spent in a block of code, for Metrics."""
+
+  def __init__(self, metrics, section, key):
+    self.metrics = metrics
+    self.section = section
+    self.key = key
+
+  def __enter__(self):
+    self.start = time.time()
+
+  def __exit__(self, *exception):
+    self.metrics.count(self.section, self.key, calls=1, seconds=time.time() - self.start)
+
+metrics = Metrics() # timings and counters for the run, shared by all fetches
+
+class HostThrottle:
+  """Spaces out requests to each host so that no host receives more than its requests-per-second budget.
+     The spacing of a rate-limited host adapts to how it responds: it backs off when the host signals overload (429 or 503
+     responses, Retry-After delays or failed requests) or when its typical response time has grown well beyond its usual
+     spread, and recovers gradually towards the budget otherwise. Single slow responses, from jitter or large results,
+     don't count. Hosts without a budget are never paced, though their Retry-After delays are still honoured.
+     Safe to share between fetching threads, so requests to different hosts overlap freely."""
+
+  BACKOFF = 2. # interval multiplier when a host signals overload
+  SLOWDOWN = 1.5 # interval multiplier when a host's recent responses are much slower than usual
+  RECOVERY = 0.8 # interval multiplier after a normal response
+  LATENCY_WINDOW = 100 # response times kept for each host
+  RECENT_LATENCIES = 9 # most recent response times, whose median is the host's current response time
+  SLOW_FACTOR = 4. # how many times its usual 90th percentile response time a host's current one must be to count as slow
+
+  def __init__(self, rate=1., rates=None, max_interval=60.):
+    self.rate = rate # default requests per second for any host, zero or less for unlimited
+    self.rates = rates or {} # host-specific requests per second
+    self.max_interval = max_interval # seconds, the most a host's requests are spaced out by backing off
+    self.next_times = {} # earliest time of the next request to each host
+    self.intervals = {} # current spacing of requests to each host
+    self.latencies = {} # recent response times of each host, oldest first
+    self.lock = threading.Lock()
+
+  def base_interval(self, host):
+    """Returns the spacing of requests to a host given its requests-per-second budget."""
+    rate = self.rates.get(host, self.rate)
+    return 1./rate if rate > 0 else 0.
+
+  def wait(self, url):
+    """Blocks until a request to the URL's host is allowed."""
+    host = urlparse.urlsplit(url).netloc.lower()
+    with self.lock: # reserve the next free slot for this host
+      now = time.time()
+      start = max(now, self.next_times.get(host, now))
+      self.next_times[host] = start + self.intervals.get(host, self.base_interval(host))
+    if start > now:
+      metrics.count("hosts", host, throttled_seconds=start - now)
+      time.sleep(start - now)
+
+  def observe(self, url, latency, overloaded=False, retry_after=None):
+    """Adapts the spacing of requests to the URL's host to how a request to it went, given its response time,
+       whether the host signalled overload and any Retry-After delay (in seconds) it asked for."""
+    host = urlparse.urlsplit(url).netloc.lower()
+    base = self.base_interval(host)
+    with self.lock:
+      if base > 0: # unlimited hosts stay unlimited
+        latencies = self.latencies.setdefault(host, collections.deque(maxlen=self.LATENCY_WINDOW))
+        if not overloaded:
+          latencies.append(latency)
+        interval = self.intervals.get(host, base)
+        if overloaded:
+          interval = self.BACKOFF*interval
+        elif self.slowed_down(latencies):
+          interval = self.SLOWDOWN*interval
+        else:
+          interval = self.RECOVERY*interval
+        self.intervals[host] = min(max(interval, base), self.max_interval)
+      if retry_after is not None:
+        now = time.time()
+        self.next_times[host] = max(self.next_times.get(host, now), now + retry_after)
+
+  def slowed_down(self, latencies):
+    """Returns whether the median of a host's most recent response times is far above the 90th percentile of the earlier ones.
+       Needs a few times as many earlier response times as recent ones to judge."""
+    if len(latencies) < 4*self.RECENT_LATENCIES:
+      return False
+    latencies = list(latencies)
+    usual = numpy.percentile(latencies[:-self.RECENT_LATENCIES], 90)
+    return numpy.median(latencies[-self.RECENT_LATENCIES:]) > self.SLOW_FACTOR*usual
+
+throttle = HostThrottle() # per-host request rate limits shared by all fetches
+
+class HTTPError(IOError):
+  """Raised by HTTPClient for error responses."""
+
+  def __init__(self, url, code, reason):
+    IOError.__init__(self, "HTTP Error %d: %s (%s)" % (code, reason, url))
+    self.url = url
+    self.code = code
+
+class HTTPClient:
+  """Makes HTTP requests over per-host pools of keep-alive connections (going via any proxy set in the environment),
+     retrying transient failures (timeouts, dropped connections, 429 and 5xx responses) with jittered exponential backoff.
+     Every attempt is paced by the throttle, which is told how each one went. Safe to share between fetching threads."""
+
+  RETRY_STATUSES = (429, 500, 502, 503, 504)
+  OVERLOAD_STATUSES = (429, 503)
+  REDIRECT_STATUSES = (301, 302, 303, 307)
+  MAX_REDIRECTS = 5
+
+  def __init__(self, timeout=60., retries=3, backoff=1., max_idle=8):
+    self.timeout = timeout # seconds to wait to connect or for data
+    self.retries = retries # further attempts after a transient failure
+    self.backoff = backoff # seconds, the upper bound of the first random delay before retrying, doubled for each retry
+    self.max_idle = max_idle # idle connections kept open to each host
+    self.idle = {} # idle connections by route
+    self.proxies = urllib.getproxies()
+    self.lock = threading.Lock()
+
+  def route(self, url):
+    """Returns the route of a request to a URL, as (scheme, host to connect to, host to tunnel to or None),
+       and the target to request from that host."""
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    target = urlparse.urlunsplit(("", "", path or "/", query, ""))
+    proxy = self.proxies.get(scheme)
+    if proxy and not urllib.proxy_bypass(netloc.split(":")[0]):
+      proxy_netloc = urlparse.urlsplit(proxy).netloc or proxy
+      if scheme == "https":
+        return (scheme, proxy_netloc, netloc), target # tunnel through the proxy
+      return (scheme, proxy_netloc, None), urlparse.urlunsplit((scheme, netloc, path or "/", query, ""))
+    return (scheme, netloc, None), target
+
+  def connect(self, route):
+    """Returns an idle connection for a route if there is one, otherwise a new connection."""
+    with self.lock:
+      if self.idle.get(route):
+        return self.idle[route].pop()
+    scheme, netloc, tunnel = route
+    connection = (httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection)(netloc, timeout=self.timeout)
+    if tunnel:
+      connection.set_tunnel(tunnel)
+    connection.reused = False
+    return connection
+
+  def release(self, route, connection):
+    """Keeps a connection open for reuse, unless enough connections to its host are already idle."""
+    connection.reused = True
+    with self.lock:
+      idle = self.idle.setdefault(route, [])
+      if len(idle) < self.max_idle:
+        idle.append(connection)
+        return
+    connection.close()
+
+  def exchange(self, url, data, headers):
+    """Makes one request over a pooled connection and returns the response's (status, reason, headers, body).
+       A reused connection that the server has since closed is replaced by a fresh one without counting as a failure."""
+    route, target = self.route(url)
+    if not target.startswith("/"): # proxied, so name the real host
+      headers = dict(headers, Host=urlparse.urlsplit(url).netloc)
+    while True:
+      connection = self.connect(route)
+      try:
+        connection.request("POST" if data is not None else "GET", target, data, headers)
+        response = connection.getresponse()
+        body = response.read()
+      except (socket.error, httplib.HTTPException) as e:
+        connection.close()
+        if connection.reused and not isinstance(e, socket.timeout):
+          continue # stale keep-alive connection
+        raise
+      if response.will_close:
+        connection.close()
+      else:
+        self.release(route, connection)
+      return response.status, response.reason, response.msg, body
+
+  def attempt(self, url, data, headers):
+    """Makes a request, retrying transient failures, and returns the final response's (status, reason, headers, body).
+       Raises the socket or httplib error of the last attempt if every attempt failed to get a response."""
+    host = urlparse.urlsplit(url).netloc.lower()
+    for retry in itertools.count():
+      throttle.wait(url) # respect request throttling recommendations
+      start = time.time()
+      try:
+        status, reason, response_headers, body = self.exchange(url, data, headers)
+      except (socket.error, httplib.HTTPException) as e:
+        throttle.observe(url, time.time() - start, overloaded=True)
+        metrics.count("hosts", host, requests=1, failures=1, seconds=time.time() - start, bytes_sent=len(data or ""))
+        if retry >= self.retries:
+          raise
+        error, retry_after = e, None
+      else:
+        retry_after = parse_retry_after(response_headers.getheader("Retry-After")) if status in self.OVERLOAD_STATUSES else None
+        throttle.observe(url, time.time() - start, status in self.OVERLOAD_STATUSES, retry_after)
+        metrics.count("hosts", host, requests=1, failures=int(status >= 400), seconds=time.time() - start, bytes_sent=len(data or ""), bytes_received=len(body))
+        if status not in self.RETRY_STATUSES or retry >= self.retries:
+          return status, reason, response_headers, body
+        error = "%d %s" % (status, reason)
+      delay = retry_after if retry_after is not None else random.uniform(0, self.backoff*2**retry)
+      metrics.count("hosts", host, retries=1, retry_delay_seconds=delay)
+      print "  Retrying %s in %.1fs (%s)" % (url, delay, error)
+      time.sleep(delay)
+
+  def request(self, url, data=None, headers=None):
+    """Returns the body of the response to a GET from a URL, or a POST of any form data, following redirects.
+       Raises HTTPError for error responses, or the underlying error if the host couldn't be reached."""
+    headers = dict([("User-Agent", "libned"), ("Accept-Encoding", "identity")] + (headers or {}).items())
+    if data is not None:
+      headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+    for redirect in xrange(self.MAX_REDIRECTS + 1):
+      status, reason, response_headers, body = self.attempt(url, data, headers)
+      if status in self.REDIRECT_STATUSES and response_headers.getheader("Location"):
+        url = urlparse.urljoin(url, response_headers.getheader("Location"))
+        if status != 307: # follow with a GET, as browsers do
+          data = None
+          headers.pop("Content-Type", None)
+        continue
+      if status >= 400:
+        raise HTTPError(url, status, reason)
+      return body
+    raise HTTPError(url, status, "Too many redirects")
+
+def parse_retry_after(value):
+  """Returns the delay in seconds asked for by a Retry-After header (given as seconds or as a date), or None."""
+  if not value:
+    return
+  try:
+    return max(0., float(value))
+  except ValueError:
+    date = email.utils.parsedate_tz(value)
+    return max(0., email.utils.mktime_tz(date) - time.time()) if date else None
+
+client = HTTPClient() # shared by all fetches
+
+def normalise_query(url, data=None):
+  """Builds a cache key from a service URL and its query parameters (and any form data), independent of parameter order."""
+  scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+  parameters = sorted(urlparse.parse_qsl(query, keep_blank_values=True) + urlparse.parse_qsl(data or "", keep_blank_values=True))
+  return "%s://%s%s?%s" % (scheme.lower(), netloc.lower(), path, urllib.urlencode(parameters))
+
+def cached(key, download):
+  """Returns the cached response for a normalised query key, otherwise calls download and caches its response.
+     Concurrent requests for the same key wait for and share a single download."""
+  global requests_saved
+  host = urlparse.urlsplit(key).netloc
+  data = cache.get(key) if cache else None
+  if data is not None:
+    metrics.count("cache", host, hits=1, bytes=len(data))
+    return data
+  with downloads_lock:
+    shared = downloads.get(key)
+    owner = shared is None
+    if owner:
+      shared = downloads[key] = {"done": threading.Event()}
+    else:
+      requests_saved += 1
+  metrics.count("cache", host, **{"misses" if owner else "shared": 1})
+  if not owner: # another thread is already downloading
+    shared["done"].wait()
+    if "data" not in shared:
+      raise IOError("Shared download failed: %s" % key)
+    return shared["data"]
+  try:
+    shared["data"] = download()
+    if cache: cache.put(key, shared["data"])
+    return shared["data"]
+  finally:
+    with downloads_lock:
+      del downloads[key]
+    shared["done"].set()
+
+def fetch(url, data=None, content_type=None, key=None):
+  """Returns the raw response from a URL (POSTing any form data), using the response cache where possible.
+     Data that isn't urlencoded needs its content type and its own normalised cache key."""
+  def download():
+    return client.request(url, data, {"Content-Type": content_type} if content_type else None) # errors on server errors so they aren't cached
+  return cached(key or normalise_query(url, data), download)
+
+def get_galex_form():
+  """Fetches the GALEX search page once and returns its form's default (name, value) fields, as a browser would submit them."""
+  global galex_form
+  with galex_form_lock:
+    if galex_form is None:
+      import bs4
+      form = bs4.BeautifulSoup(client.request(GALEX_SEARCH_PAGE)).find("form") # assume only one form on the page
+      fields = [(node["name"], node.get("value", "")) for node in form.find_all("input", attrs={"name": True}) if node.get("type", "text").lower() in ("hidden", "text")]
+      fields += [(node["name"], node.get("value", "")) for node in form.find_all("input", attrs={"name": True, "type": re.compile("^submit$", re.IGNORECASE)})][:1] # the first submit button
+      fields += [(node["name"], node.get_text()) for node in form.find_all("textarea", attrs={"name": True})]
+      fields += [(node["name"], (node.find("option", selected=True) or node.find("option"))["value"]) for node in form.find_all("select", attrs={"name": True}) if node.find("option")]
+      galex_form = (urlparse.urljoin(GALEX_SEARCH_PAGE, form.get("action", "")), fields)
+  return galex_form
+
+def query_galex(query):
+  """Posts an SQL query to the GALEX search form with the output format set to votable,
+     finds the output xml in the response and returns it."""
+  action, fields = get_galex_form()
+  overrides = {"_ctl10:QueryTextbox": query, "_ctl10:ofmt": "VOT"} # set the query and the output to votable xml
+  response = client.request(action, urllib.urlencode([(name, overrides.get(name, value)) for name, value in fields])) # send off the modified form
+  with metrics.timer("parsing", "html"):
+    import bs4
+    html = bs4.BeautifulSoup(response)
+
+  popup_js = html.find("script", text=re.compile("^window.open\('tmp\/galex_\S+\.xml'\)$")).find(text=True) # returns the content of the script tag
+  url = "http://galex.stsci.edu/GR6/" + re.compile("tmp\/galex_\S+\.xml").search(popup_js).group() # grabs the temp file name and constructs the url
   print " ", url
+
+  return client.request(url) # the temp file is only useful once so is never cached by itself
+
+def get_galex_votables(sources):
+  """Fetches GALEX data for many sources with a single SQL query made up of a subquery per source position.
+     Returns each source's rows of the result, in the same order as the sources (or Nones if the query failed)."""
+  query = GALEX_BATCH_SQL_QUERY % {"subqueries": " UNION ALL ".join(\
+    "SELECT * FROM (%s) AS q%d" % (GALEX_BATCH_SQL_SUBQUERY % {"source_id": source_id, "lat": source.search_lat(), "lon": source.search_lon()}, source_id) \
+    for source_id, source in enumerate(sources, 1))}
+  print "  %s (%d positions)" % (GALEX_SEARCH_PAGE, len(sources))
+  try:
+    table = parse_votable(cached(normalise_query(GALEX_SEARCH_PAGE, urllib.urlencode({"query": query})), lambda: query_galex(query)), GALEX_COLUMNS + ("source_id",))
+    source_ids = numpy.asarray(table.array["source_id"].data, dtype=int)
+    return [TableRows(table, numpy.flatnonzero(source_ids == source_id)) for source_id in range(1, len(sources)+1)] # demultiplex rows back to sources
+  except:
+    print "  Could not download or interpret data from %s. You may not be connected to the Internet or the input data contains unrecognised names or coordinates." % GALEX_SEARCH_PAGE
+    return [None]*len(sources)
+
+def encode_multipart(fields, files):
+  """Encodes form fields and (name, filename, content) files as multipart/form-data.
+     Returns the content type and the body."""
+  boundary = "----------libned%s" % hashlib.sha1(repr((fields, files))).hexdigest()
+  parts = ["--%s\r\nContent-Disposition: form-data; name=\"%s\"\r\n\r\n%s\r\n" % (boundary, name, value) for name, value in fields]
+  parts += ["--%s\r\nContent-Disposition: form-data; name=\"%s\"; filename=\"%s\"\r\nContent-Type: text/plain\r\n\r\n%s\r\n" % (boundary, name, filename, content) for name, filename, content in files]
+  return "multipart/form-data; boundary=%s" % boundary, "".join(parts) + "--%s--\r\n" % boundary
+
+def get_gator_votables(sources, catalog, columns):
+  """Fetches data for many sources with a single Gator multi-object query against an uploaded table of their positions.
+     Returns each source's rows of the result, in the same order as the sources (or Nones if the query failed)."""
+  upload = "|source_id|ra        |dec       |\n|int      |double    |double    |\n" + "".join(\
+    " %-9d %-10.5f %-10.5f\n" % (source_id, source.search_lat(), source.search_lon()) for source_id, source in enumerate(sources, 1)) # ipac table format
+  fields = [("catalog", catalog), ("spatial", "Upload"), ("uradius", "%g" % Source.tolerance), ("uradunits", "arcsec"), ("outfmt", "3")]
+  content_type, data = encode_multipart(fields, [("filename", "upload.tbl", upload)])
+  print "  %s (%s, %d positions)" % (GATOR_UPLOAD_PATH, catalog, len(sources))
+  try:
+    table = parse_votable(fetch(GATOR_UPLOAD_PATH, data, content_type, normalise_query(GATOR_UPLOAD_PATH, urllib.urlencode(fields + [("upload", upload)]))), columns + (GATOR_UPLOAD_ID_COLUMN,))
+    source_ids = numpy.asarray(table.array[GATOR_UPLOAD_ID_COLUMN].data, dtype=int)
+    return [TableRows(table, numpy.flatnonzero(source_ids == source_id)) for source_id in range(1, len(sources)+1)] # demultiplex rows back to sources
+  except:
+    print "  Could not download or interpret data from %s. You may not be connected to the Internet or the input data contains unrecognised names or coordinates." % GATOR_UPLOAD_PATH
+    return [None]*len(sources)
+
+def pending(sources, stage):
+  """Returns the (index, source) pairs of the sources which haven't completed a stage of processing."""
+  return [(source.index, source) for source in sources if stage not in source.completed_stages]
+
+class SkyGrid:
+  """A spatial index of items at positions on the sky, bucketed by position on the unit sphere into cubes the size of the search radius
+     so that finding the items near a position only needs to look in neighbouring cubes."""
+
+  def __init__(self, radius):
+    self.chord = 2*math.sin(math.radians(radius/3600.)/2) # search radius as a straight-line distance between unit vectors
+    self.cells = {} # (position vector, item) pairs by cube
+
+  def vector(self, lat, lon):
+    """Converts a latitude and longitude (decimal degrees) to a unit vector."""
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lon)*math.cos(lat), math.cos(lon)*math.sin(lat), math.sin(lon))
+
+  def cell(self, vector):
+    return tuple(int(math.floor(component/self.chord)) for component in vector)
+
+  def add(self, lat, lon, item):
+    """Indexes an item at a position."""
+    vector = self.vector(lat, lon)
+    self.cells.setdefault(self.cell(vector), []).append((vector, item))
+
+  def nearest(self, lat, lon):
+    """Returns the indexed item nearest to a position within the search radius, or None."""
+    vector = self.vector(lat, lon)
+    x, y, z = self.cell(vector)
+    candidates = [(sum((a-b)**2 for a, b in zip(vector, other)), item) \
+                  for neighbour in itertools.product((x-1, x, x+1), (y-1, y, y+1), (z-1, z, z+1)) \
+                  for other, item in self.cells.get(neighbour, ())]
+    candidates = [(distance, item) for distance, item in candidates if distance <= self.chord**2]
+    return min(candidates, key=lambda (distance, item): distance)[1] if candidates else None
+
+def coalesce(sources, stage, radius=0.):
+  """Groups sources whose downloads for a stage of processing can be shared, as lists led by the source whose query is made.
+     NED SED queries are shared by sources with the same search name and position queries by sources with the same query position,
+     or, for catalogue queries, by sources within radius arcseconds of a group's leader if a radius is given. Extinction is looked up
+     at a single position, so it is only shared by sources at the same position. Sources which won't make a query are left alone."""
+  groups = []
+  leaders = {} # groups by the name or position of their leader's query
+  grid = SkyGrid(radius) if radius > 0 and stage not in ("ned_sed", "dust") else None
+  for source in sources:
+    key, group = None, None
+    if stage == "ned_sed":
+      key = source.search_name
+    elif source.has_search_position():
+      key = "%.5f %.5f" % (source.search_lat(), source.search_lon()) # as formatted in queries
+      if grid and key not in leaders:
+        group = grid.nearest(source.search_lat(), source.search_lon())
+    if key:
+      group = leaders.get(key, group)
+    if group is not None:
+      group.append(source)
+      continue
+    group = [source]
+    groups.append(group)
+    if key:
+      leaders[key] = group
+      if grid:
+        grid.add(source.search_lat(), source.search_lon(), group)
+  return groups
+
+def fan_out(groups, name):
+  """Shares the data each group's leader has downloaded, stored as the named attribute, with the rest of its group.
+     Returns the number of requests saved."""
+  global requests_saved
+  saved = 0
+  for group in groups:
+    for source in group[1:]:
+      setattr(source, name, getattr(group[0], name))
+      saved += 1
+  with downloads_lock:
+    requests_saved += saved
+  return saved
+
+def fetch_jobs(sources, name, method):
+  """Builds download jobs which fetch data for each source with a Source method and store it as the named attribute."""
+  return [lambda source=source: setattr(source, name, method(source)) for source in sources]
+
+def gator_batch_jobs(sources, name, catalog, columns, batch_size):
+  """Builds download jobs which fetch Gator data for batches of sources with multi-object queries and store each source's rows as the named attribute.
+     Sources without a position are left alone."""
+  sources = [source for source in sources if source.has_search_position()]
+  def job(batch):
+    for source, table in zip(batch, get_gator_votables(batch, catalog, columns)):
+      setattr(source, name, table)
+  return [lambda batch=sources[start:start+batch_size]: job(batch) for start in range(0, len(sources), batch_size)]
+
+def galex_batch_jobs(sources, batch_size):
+  """Builds download jobs which fetch GALEX data for batches of sources with single SQL queries and store each source's rows.
+     Sources without a position are left alone."""
+  sources = [source for source in sources if source.has_search_position()]
+  batch_size = min(batch_size, GALEX_MAX_BATCH)
+  def job(batch):
+    for source, table in zip(batch, get_galex_votables(batch)):
+      source.galex = table
+  return [lambda batch=sources[start:start+batch_size]: job(batch) for start in range(0, len(sources), batch_size)]
+
+def download_all(pool, *job_lists):
+  """Runs download jobs concurrently in the thread pool, limited only by the throttle.
+     The job lists are interleaved so that downloads from different hosts overlap."""
+  jobs = [job for jobs in itertools.izip_longest(*job_lists) for job in jobs if job]
+  pool.map_async(lambda job: job(), jobs, chunksize=1).get(sys.maxint) # timeout keeps the main thread interruptible
+
+def stream(pool, sources, window=64, process=lambda source: source.process(source.index)):
+  """Processes sources concurrently in the thread pool, yielding each (in input order) as soon as it is complete, or whatever
+     else process returns for it. At most window sources are in flight at once so memory use doesn't grow with the size of the input.
+     Sources are submitted one at a time rather than through the pool's shared task feeder, so a stream that is read slowly
+     or abandoned never holds up other streams on the same pool."""
+  pending = collections.deque() # results of the sources in flight, in input order
+  try:
+    for source in sources:
+      pending.append(pool.apply_async(process, (source,)))
+      if len(pending) >= window:
+        yield pending.popleft().get(sys.maxint) # timeout keeps the thread interruptible
+    while pending:
+      yield pending.popleft().get(sys.maxint)
+  finally: # closed early: forget the sources in flight, which finish in the pool without anyone waiting for them
+    pending.clear()
+
+LOOKUP_FIELDS = ("ned_name", "nvss_id", "input_lat", "input_lon") # the input fields that processing a source depends on
+
+def source_results(source):
+  """Returns the results of processing a source as values JSON can carry: the attributes its stages set, its data points
+     and whether every stage completed."""
+  return {\
+    "name": source.name, \
+    "complete": len(source.completed_stages) == len(Checkpoint.STAGES), \
+    "state": dict((name, getattr(source, name)) for stage in Checkpoint.STAGES for name in Checkpoint.STAGE_FIELDS.get(stage, ())), \
+    "points": [[getattr(point, name) for name in Checkpoint.POINT_FIELDS] for point in source.points]\
+   }
+
+def restore_results(source, results):
+  """Gives a source the results of processing it elsewhere, as returned by source_results. Returns the source."""
+  for name, value in results["state"].items():
+    setattr(source, name, from_json(value))
+  for values in results["points"]:
+    data = dict(zip(Checkpoint.POINT_FIELDS, map(from_json, values)))
+    data["index"] = source.index # the source's position in this input, not the server's
+    source.points.append(DataPoint(source, data))
+  if results["complete"]:
+    source.completed_stages.update(Checkpoint.STAGES)
+  return source
+
+class LookupService:
+  """Looks up sources for the clients of a long-running server. Each source is processed as in a stream, and its results are
+     kept in an in-memory LRU by the input fields they depend on. Concurrent lookups of the same source wait for and share
+     a single run of its processing."""
+
+  def __init__(self, pool, max_sources=100000, window=64):
+    self.pool = pool
+    self.max_sources = max_sources
+    self.window = window
+    self.results = collections.OrderedDict() # results of complete sources by key, least recently used first
+    self.lookups = {} # lookups in progress by key, shared by concurrent lookups of the same source
+    self.lock = threading.Lock()
+
+  def lookup(self, source):
+    """Returns a source's results, processing it unless they are cached or it is already being processed."""
+    key = tuple(getattr(source, name) for name in LOOKUP_FIELDS)
+    with self.lock:
+      results = self.results.pop(key, None)
+      if results is not None:
+        self.results[key] = results # now the most recently used
+      else:
+        shared = self.lookups.get(key)
+        owner = shared is None
+        if owner:
+          shared = self.lookups[key] = {"done": threading.Event()}
+    if results is not None:
+      metrics.count("lookups", "sources", hits=1)
+      return results
+    metrics.count("lookups", "sources", **{"misses" if owner else "shared": 1})
+    if not owner: # another thread is already processing the source
+      shared["done"].wait()
+      if "results" not in shared:
+        raise IOError("Shared lookup failed: %s" % source.name)
+      return shared["results"]
+    try:
+      shared["results"] = source_results(source.process(source.index))
+      if shared["results"]["complete"]: # sources with failed downloads are retried by later lookups
+        with self.lock:
+          self.results[key] = shared["results"]
+          while len(self.results) > self.max_sources:
+            self.results.popitem(last=False)
+      return shared["results"]
+    finally:
+      with self.lock:
+        del self.lookups[key]
+      shared["done"].set()
+
+  def stream(self, sources):
+    """Looks up sources concurrently, yielding the results of each (in order) as soon as they are ready."""
+    return stream(self.pool, sources, self.window, self.lookup)
+
+  def status(self):
+    """Returns the numbers of sources cached and being looked up, with the run's counters so far."""
+    with self.lock:
+      status = {"sources_cached": len(self.results), "lookups_in_progress": len(self.lookups), "requests_saved": requests_saved}
+    status.update(metrics.counters())
+    return status
+
+class LookupHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves a LookupService over HTTP with JSON. A POST to /lookup of {"sources": [...]}, with an object of the LOOKUP_FIELDS
+     of each source, is answered with a line of JSON results for each source in turn, each sent as soon as it is ready.
+     A GET of /status returns the service's status."""
+
+  def do_GET(self):
+    if self.path != "/status":
+      return self.send_error(404)
+    self.send_json([self.server.service.status()])
+
+  def do_POST(self):
+    if self.path != "/lookup":
+      return self.send_error(404)
+    try:
+      request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+      sources = [Source("", dict((name, from_json(fields[name])) for name in LOOKUP_FIELDS if fields.get(name) is not None), index) for index, fields in enumerate(request["sources"], 1)]
+    except Exception:
+      return self.send_error(400, "Expected {\"sources\": [...]} with an object of %s for each source" % ", ".join(LOOKUP_FIELDS))
+    self.send_json(self.server.service.stream(sources))
+
+  def send_json(self, values):
+    """Sends each of a sequence of values as a line of JSON as it becomes available. Without a length, the response ends when the connection closes."""
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.end_headers()
+    values = iter(values)
+    try:
+      for value in values:
+        self.wfile.write(json.dumps(value) + "\n")
+        self.wfile.flush()
+    finally: # the client may have gone away: stop a stream of lookups now rather than when it is collected
+      if hasattr(values, "close"):
+        values.close()
+
+  def log_message(self, format, *args):
+    print "  Lookup server: %s" % (format % args)
+
+class LookupServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Serves a LookupService on a TCP address, handling each connection in its own thread."""
+  daemon_threads = True
+
+  def __init__(self, address, service):
+    BaseHTTPServer.HTTPServer.__init__(self, address, LookupHandler)
+    self.service = service
+
+class UnixLookupServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """Serves a LookupService on a Unix socket, handling each connection in its own thread."""
+  daemon_threads = True
+
+  def __init__(self, path, service):
+    SocketServer.UnixStreamServer.__init__(self, path, LookupHandler)
+    self.service = service
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    os.remove(self.server_address)
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+  """An HTTP connection over a Unix socket."""
+
+  def __init__(self, path, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+    self.socket_path = path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+      self.sock.settimeout(self.timeout)
+    self.sock.connect(self.socket_path)
+
+def parse_lookup_address(text):
+  """Returns the (host, port) of a lookup server given as [HOST:]PORT, or else the path of its Unix socket."""
+  host, separator, port = text.rpartition(":")
+  if port.isdigit() and "/" not in text:
+    return host or "127.0.0.1", int(port)
+  return text
+
+def serve_lookups(address, service):
+  """Returns a server for a LookupService on an address as returned by parse_lookup_address, ready to serve_forever."""
+  return UnixLookupServer(address, service) if isinstance(address, str) else LookupServer(address, service)
+
+def lookup_connection(address, timeout=None):
+  """Returns an HTTP connection to a lookup server at an address as returned by parse_lookup_address."""
+  return UnixHTTPConnection(address, timeout) if isinstance(address, str) else httplib.HTTPConnection(*address, timeout=timeout)
+
+def lookup_status(address, timeout=None):
+  """Returns the status of a lookup server, as returned by LookupService.status."""
+  connection = lookup_connection(address, timeout)
   try:
-    xml_file = urllib.urlopen(url) # grab xml file-like-object from the web
-    time.sleep(1) # respect request throttling recommendations
+    connection.request("GET", "/status")
+    response = connection.getresponse()
+    if response.status != 200:
+      raise HTTPError("/status", response.status, response.reason)
+    return json.loads(response.read())
+  finally:
+    connection.close()
+
+def look_up(address, sources, timeout=None, batch_size=1000):
+  """Looks up sources with a lookup server at an address as returned by parse_lookup_address, a batch at a time.
+     Yields each source (in order) as soon as the server's results for it have been restored onto it."""
+  sources = iter(sources)
+  while True:
+    batch = list(itertools.islice(sources, batch_size))
+    if not batch:
+      return
+    connection = lookup_connection(address, timeout)
+    try:
+      connection.request("POST", "/lookup", json.dumps({"sources": [dict((name, getattr(source, name)) for name in LOOKUP_FIELDS) for source in batch]}), {"Content-Type": "application/json"})
+      response = connection.getresponse()
+      if response.status != 200:
+        raise HTTPError("/lookup", response.status, response.reason)
+      for source in batch:
+        line = response.fp.readline() # the response is read as it streams in
+        if not line:
+          raise IOError("Lookup server closed the connection early")
+        metrics.advance(len(Checkpoint.STAGES))
+        yield restore_results(source, json.loads(line))
+    finally:
+      connection.close()
+
+class VOTableFallback(Exception):
+  """Raised by read_votable for votables using features it doesn't handle, which astropy should parse instead."""
+
+def read_votable(stream, columns=None, text_columns=False):
+  """Reads the first table of a TABLEDATA-serialised votable from a file-like object, decoding only the named columns
+     (all columns if None, plus every text column if text_columns is set) straight into a masked record array.
+     Rows are discarded as they are read so large responses can be read incrementally.
+     Values are typed and masked as astropy would. Raises VOTableFallback for other serialisations or datatypes."""
+  fields = [] # (name, datatype, arraysize, null) for each field of the table
+  selected = None # (field number, name, datatype, arraysize, null) for each column to be decoded
+  rows = [] # raw strings of the selected cells of each row
+  strings = {} # one copy of each distinct cell string, since most cells repeat
+  def select(): # called once all fields have been read
+    selected = [(number,) + field for number, field in enumerate(fields) \
+                if columns is None or field[0] in columns or (text_columns and field[1] in ("char", "unicodeChar"))]
+    for number, name, datatype, arraysize, null in selected:
+      if datatype not in VOTABLE_DATATYPES or (arraysize and datatype not in ("char", "unicodeChar")):
+        raise VOTableFallback("%s[%s]" % (datatype, arraysize))
+    return selected
+
+  tags = {} # local names of namespaced tags
+  for event, element in xml.etree.cElementTree.iterparse(stream, events=("start", "end")):
+    tag = tags.get(element.tag) or tags.setdefault(element.tag, element.tag.rsplit("}", 1)[-1]) # ignore any namespace
+    if event == "start":
+      if tag in ("BINARY", "BINARY2", "FITS"):
+        raise VOTableFallback(tag)
+      elif tag == "TABLEDATA":
+        selected = select()
+        pick = lambda cells, numbers=[number for number, name, datatype, arraysize, null in selected]: [strings.setdefault(cells[number], cells[number]) if number < len(cells) else None for number in numbers]
+        tabledata = element
+    elif tag == "TR":
+      if any(cell.attrib for cell in element):
+        raise VOTableFallback("encoded cell")
+      rows.append(pick([cell.text for cell in element]))
+      tabledata.clear() # discard rows once read
+    elif tag == "FIELD" and selected is None:
+      nulls = [node.get("null") for node in element if tags.get(node.tag) == "VALUES"]
+      fields.append((element.get("name") or element.get("ID"), element.get("datatype"), element.get("arraysize"), nulls[0] if nulls else None))
+    elif tag == "TABLE":
+      if selected is None: # no data
+        selected = select()
+      break
+  if selected is None:
+    raise ValueError("No table found")
+
+  names = [name for number, name, datatype, arraysize, null in selected]
+  if not names:
+    return ColumnTable(numpy.ma.array(numpy.zeros(len(rows), dtype=[])))
+  arrays, masks = [], []
+  for number, name, datatype, arraysize, null in reversed(selected): # decode and free the raw strings a column at a time
+    array, mask = decode_votable_column([row.pop() or "" for row in rows], datatype, arraysize, null)
+    arrays.insert(0, array)
+    masks.insert(0, mask)
+  array = numpy.rec.fromarrays(arrays, names=names)
+  mask = numpy.zeros(len(array), dtype=[(name, bool) for name in names])
+  for name, column_mask in zip(names, masks):
+    mask[name] = column_mask
+  return ColumnTable(numpy.ma.array(array, mask=mask))
+
+VOTABLE_DATATYPES = {"double": "f8", "float": "f4", "long": "i8", "int": "i4", "short": "i2", "unsignedByte": "u1", "boolean": "?", "char": "O", "unicodeChar": "O"}
+
+def decode_votable_column(column, datatype, arraysize, null):
+  """Converts a column of raw votable strings to an array and a mask, with the types and masking that astropy uses."""
+  if datatype in ("char", "unicodeChar"): # never masked
+    if datatype == "char":
+      column = [value.encode("utf-8") if isinstance(value, unicode) else value for value in column]
+    else:
+      column = [unicode(value) for value in column]
+    if arraysize and arraysize != "*" and not arraysize.endswith("*"): # fixed width
+      return numpy.array(column, dtype=("S%s" if datatype == "char" else "U%s") % arraysize.split("x")[0]), numpy.zeros(len(column), dtype=bool)
+    array = numpy.empty(len(column), dtype=object)
+    array[:] = column
+    return array, numpy.zeros(len(column), dtype=bool)
+  if datatype == "boolean": # empty or ? is masked false
+    column = [value.strip().lower() for value in column]
+    return numpy.array([value in ("t", "true", "1") for value in column], dtype=bool), numpy.array([value in ("", "?") for value in column], dtype=bool)
+  if datatype in ("double", "float"): # empty or nan is masked nan
+    array = numpy.array([value.strip() or "nan" for value in column] or [], dtype="S").astype(VOTABLE_DATATYPES[datatype])
+    return array, numpy.isnan(array)
+  # integers: empty is the null value if there is one (and masked) otherwise 0 (and not masked)
+  array = numpy.array([value.strip() or (null if null is not None else "0") for value in column] or [], dtype="S").astype(VOTABLE_DATATYPES[datatype])
+  return array, (array == numpy.array(null).astype(VOTABLE_DATATYPES[datatype])) if null is not None else numpy.zeros(len(array), dtype=bool)
+
+class ColumnTable:
+  """A table read by read_votable, providing the same array interface to the parsers as an astropy votable."""
+
+  def __init__(self, array):
+    self.array = array
+
+class LocalCatalogue:
+  """A local copy of a catalogue searched in place of a remote service: a directory of .npy column files, a FITS table or an HDF5 file
+     of column datasets, with columns named as the service names them (positions in ra and dec, decimal degrees).
+     Columns are memory-mapped (HDF5 datasets are read on demand) and cone searches go through a zones index, in which rows are sorted
+     by declination zone and then by RA. The index is built on first use and saved alongside the catalogue."""
+
+  def __init__(self, path, radius=10., max_rows=None):
+    self.path = path
+    self.radius = radius # arcseconds
+    self.max_rows = max_rows # nearest rows returned, all if None
+    self.columns = self.open_columns()
+    self.index_directory = os.path.join(path, "index") if os.path.isdir(path) else path + ".index"
+    self.order, self.ras, self.decs, self.zone_starts = self.load_index() # rows, their positions and the first of each zone, in index order
+
+  def open_columns(self):
+    """Returns the catalogue's columns by name."""
+    if os.path.isdir(self.path):
+      return dict((name[:-len(".npy")], numpy.load(os.path.join(self.path, name), mmap_mode="r")) for name in os.listdir(self.path) if name.endswith(".npy"))
+    extension = os.path.splitext(self.path)[1].lower()
+    if extension in (".fits", ".fit", ".fts"):
+      import astropy.io.fits
+      data = astropy.io.fits.open(self.path, memmap=True)[1].data
+      return dict((name.lower(), data.field(name)) for name in data.names) # fits column names are case-insensitive
+    if extension in (".h5", ".hdf5"):
+      try:
+        import h5py # optional, only needed for hdf5 catalogues
+      except ImportError:
+        raise ImportError("h5py is needed to read HDF5 catalogues such as %s" % self.path)
+      catalogue = h5py.File(self.path, "r")
+      return dict((name, dataset) for name, dataset in catalogue.items() if isinstance(dataset, h5py.Dataset))
+    raise ValueError("Unrecognised catalogue format: %s" % self.path)
+
+  def zone(self, dec):
+    """Returns the index zone (or zones, for an array) of a declination."""
+    return numpy.clip(numpy.floor((numpy.asarray(dec) + 90)*3600/LOCAL_ZONE_HEIGHT).astype(int), 0, int(math.ceil(180*3600/LOCAL_ZONE_HEIGHT)) - 1)
+
+  def load_index(self):
+    """Loads the zones index, building and saving it first if it is missing or doesn't match the catalogue."""
+    zones = int(math.ceil(180*3600/LOCAL_ZONE_HEIGHT))
+    paths = [os.path.join(self.index_directory, "%s.npy" % name) for name in ("order", "ra", "dec", "zones")]
+    try:
+      index = [numpy.load(path, mmap_mode="r") for path in paths]
+      if len(index[0]) == len(self.columns["ra"]) and len(index[3]) == zones + 1:
+        return index
+    except IOError: pass
+    print "  Building index for local catalogue:", self.path
+    ras = numpy.asarray(self.columns["ra"][:], dtype=float)
+    decs = numpy.asarray(self.columns["dec"][:], dtype=float)
+    row_zones = self.zone(decs)
+    order = numpy.lexsort((ras, row_zones))
+    index = [order, ras[order], decs[order], numpy.searchsorted(row_zones[order], numpy.arange(zones + 1))]
+    try:
+      if not os.path.isdir(self.index_directory):
+        os.makedirs(self.index_directory)
+      for path, array in zip(paths, index):
+        with open(path + ".tmp", "wb") as index_file:
+          numpy.save(index_file, array)
+        os.rename(path + ".tmp", path) # atomic so a partial index is never loaded
+    except (IOError, OSError):
+      print "  Could not save index for local catalogue:", self.path
+    return index
+
+  def ra_ranges(self, lat, lon, radius):
+    """Returns the ranges of RA which may hold positions within a radius of a position (all in decimal degrees), split at 0."""
+    if abs(lon) + radius >= 90:
+      return [(0., 360.)] # a pole is within the radius
+    half_width = radius/math.cos(math.radians(abs(lon) + radius)) # widest at the edge nearest the pole
+    low, high = lat - half_width, lat + half_width
+    if high - low >= 360:
+      return [(0., 360.)]
+    if low < 0:
+      return [(0., high), (low + 360, 360.)]
+    if high > 360:
+      return [(low, 360.), (0., high - 360)]
+    return [(low, high)]
+
+  def cone(self, lat, lon, columns):
+    """Returns a table of the named columns (those the catalogue has) for the rows within the search radius of a position
+       (latitude and longitude in decimal degrees), nearest first."""
+    print "  %s (%.5f %.5f)" % (self.path, lat, lon)
+    with metrics.timer("local", self.path):
+      return self.search(lat, lon, columns)
+
+  def search(self, lat, lon, columns):
+    """Does the work of cone."""
+    radius = self.radius/3600.
+    positions = [numpy.arange(start + numpy.searchsorted(self.ras[start:end], low, side="left"), start + numpy.searchsorted(self.ras[start:end], high, side="right")) \
+                 for start, end in (self.zone_starts[zone:zone+2] for zone in xrange(self.zone(lon - radius), self.zone(lon + radius) + 1)) \
+                 for low, high in self.ra_ranges(lat, lon, radius)]
+    positions = numpy.unique(numpy.concatenate(positions)) if positions else numpy.zeros(0, dtype=int)
+    separations = angular_separations(lat, lon, numpy.asarray(self.ras[positions]), numpy.asarray(self.decs[positions]))
+    nearest = numpy.argsort(separations, kind="mergesort")[:numpy.count_nonzero(separations <= self.radius)]
+    rows = numpy.asarray(self.order[positions[nearest[:self.max_rows]]])
+    names = [name for name in columns if name in self.columns]
+    unique_rows, inverse = numpy.unique(rows, return_inverse=True) # increasing, as hdf5 requires
+    arrays = [numpy.asarray(self.columns[name][unique_rows] if len(rows) else self.columns[name][:0])[inverse] for name in names]
+    arrays = [array.astype(array.dtype.newbyteorder("=")) for array in arrays] # fits is big-endian
+    if not names:
+      return ColumnTable(numpy.ma.array(numpy.zeros(len(rows), dtype=[])))
+    array = numpy.rec.fromarrays(arrays, names=names)
+    mask = numpy.zeros(len(array), dtype=[(name, bool) for name in names])
+    for name, column in zip(names, arrays):
+      if column.dtype.kind == "f": # nan is masked, as in votables
+        mask[name] = numpy.isnan(column)
+    return ColumnTable(numpy.ma.array(array, mask=mask))
+
+def dust_e_bv(tree, statistic="meanValueSandF"):
+  """Picks a statistic of the E(B-V) reddening (mag) out of an IRSA DUST xml response."""
+  e_bv_result_node = filter(lambda node: node.find("desc").text.strip() == "E(B-V) Reddening", tree.findall("./result[desc]"))[0]
+  return float(re.compile("^(?P<e_bv>[0-9]+(\.[0-9]+)?)\s*\(mag\)$", re.IGNORECASE).match(e_bv_result_node.find("statistics/%s" % statistic).text.strip()).groupdict()["e_bv"])
+
+EQUATORIAL_TO_GALACTIC = numpy.array([\
+  [-0.0548755604162154, -0.8734370902348850, -0.4838350155487132], \
+  [0.4941094278755837, -0.4448296299600112, 0.7469822444972189], \
+  [-0.8676661490190047, -0.1980763734312015, 0.4559837761750669]\
+ ]) # rotation from J2000.0 equatorial to galactic unit vectors
+
+def equatorial_to_galactic(lats, lons):
+  """Converts J2000.0 equatorial latitudes and longitudes (decimal degrees, scalars or arrays) to galactic l and b (decimal degrees)."""
+  lats, lons = numpy.radians(lats), numpy.radians(lons)
+  x, y, z = numpy.tensordot(EQUATORIAL_TO_GALACTIC, numpy.array([numpy.cos(lons)*numpy.cos(lats), numpy.cos(lons)*numpy.sin(lats), numpy.sin(lons)]), axes=1)
+  return numpy.degrees(numpy.arctan2(y, x)) % 360, numpy.degrees(numpy.arcsin(numpy.clip(z, -1, 1)))
+
+class SFDMap:
+  """The Schlegel, Finkbeiner & Davis (1998) E(B-V) map, read from its pair of Lambert projected FITS files for the galactic
+     hemispheres (memory-mapped) and looked up with bilinear interpolation in place of IRSA DUST requests.
+     Values are scaled by 0.86 by default, the Schlafly & Finkbeiner (2011) recalibration that IRSA reports as the S&F value.
+     See http://adsabs.harvard.edu/abs/1998ApJ...500..525S and http://adsabs.harvard.edu/abs/2011ApJ...737..103S."""
+
+  FILES = {1: "SFD_dust_4096_ngp.fits", -1: "SFD_dust_4096_sgp.fits"} # by hemisphere
+
+  def __init__(self, directory, scaling=0.86):
+    self.directory = directory
+    self.scaling = scaling
+    self.hemispheres = {}
+    import astropy.io.fits
+    for hemisphere, name in self.FILES.items():
+      hdu = astropy.io.fits.open(os.path.join(directory, name), memmap=True)[0]
+      header = hdu.header
+      self.hemispheres[hemisphere] = (hdu.data, header.get("CRPIX1", 2048.5), header.get("CRPIX2", 2048.5), header.get("LAM_SCAL", 2048.), header.get("LAM_NSGP", hemisphere))
+
+  def e_bv(self, lats, lons):
+    """Returns the E(B-V) reddening (mag) at J2000.0 equatorial positions (decimal degrees, scalars or arrays)."""
+    with metrics.timer("local", self.directory):
+      return self.interpolate(lats, lons)
+
+  def interpolate(self, lats, lons):
+    """Does the work of e_bv."""
+    l, b = (numpy.radians(angle) for angle in equatorial_to_galactic(lats, lons))
+    l, b = numpy.atleast_1d(l), numpy.atleast_1d(b)
+    values = numpy.empty(l.shape)
+    for hemisphere, (data, crpix1, crpix2, scale, n) in self.hemispheres.items():
+      selected = (b >= 0) if hemisphere > 0 else (b < 0)
+      radius = scale*numpy.sqrt(1 - n*numpy.sin(b[selected])) # lambert zenithal equal area projection about the pole
+      x = crpix1 - 1 + radius*numpy.cos(l[selected]) # zero-based pixel coordinates
+      y = crpix2 - 1 - n*radius*numpy.sin(l[selected])
+      values[selected] = bilinear_interpolate(data, x, y)
+    values *= self.scaling
+    return values if numpy.ndim(lats) or numpy.ndim(lons) else values[0]
+
+def bilinear_interpolate(data, x, y):
+  """Interpolates an image at arrays of zero-based pixel coordinates, clamping to the edges."""
+  x0, y0 = numpy.floor(x).astype(int), numpy.floor(y).astype(int)
+  dx, dy = x - x0, y - y0
+  height, width = data.shape
+  x1, y1 = numpy.clip(x0 + 1, 0, width - 1), numpy.clip(y0 + 1, 0, height - 1)
+  x0, y0 = numpy.clip(x0, 0, width - 1), numpy.clip(y0, 0, height - 1)
+  return (1-dx)*(1-dy)*data[y0, x0] + dx*(1-dy)*data[y0, x1] + (1-dx)*dy*data[y1, x0] + dx*dy*data[y1, x1]
+
+def look_up_dust(sources):
+  """Looks up the E(B-V) reddening of many sources in the local dust map at once, storing it as each source's dust data.
+     Sources without a position are left alone."""
+  sources = [source for source in sources if source.has_search_position()]
+  if sources:
+    for source, e_bv in zip(sources, backends["dust"].e_bv([source.search_lat() for source in sources], [source.search_lon() for source in sources]).tolist()):
+      source.dust = e_bv
+
+def check_dust_map(dust_map, responses):
+  """Compares the E(B-V) reddening looked up in a local dust map with recorded IRSA DUST responses, given as (normalised query key, response) pairs.
+     Returns (latitude, longitude, recorded S&F mean, recorded S&F reference pixel value, map value) for each response, nan where missing."""
+  recorded = []
+  for key, data in responses:
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(key)
+    if path != urlparse.urlsplit(DUST_SEARCH_PATH).path:
+      continue
+    try:
+      lat, lon = map(float, urlparse.parse_qs(query)["locstr"][0].split())
+      tree = xml.etree.ElementTree.parse(StringIO.StringIO(data))
+      statistics = []
+      for statistic in ("meanValueSandF", "refPixelValueSandF"):
+        try:
+          statistics.append(dust_e_bv(tree, statistic))
+        except:
+          statistics.append(float("nan"))
+      recorded.append((lat, lon) + tuple(statistics))
+    except: pass # not a usable response
+  if not recorded:
+    return []
+  lats, lons, means, references = zip(*recorded)
+  return zip(lats, lons, means, references, dust_map.e_bv(lats, lons).tolist())
+
+def angular_separations(lat, lon, lats, lons):
+  """Returns the angular separations (arcseconds) between a position and an array of positions (decimal degrees)."""
+  lat, lon, lats, lons = map(numpy.radians, (lat, lon, lats, lons))
+  haversines = numpy.sin((lons - lon)/2)**2 + numpy.cos(lon)*numpy.cos(lons)*numpy.sin((lats - lat)/2)**2
+  return numpy.degrees(2*numpy.arcsin(numpy.sqrt(numpy.clip(haversines, 0, 1))))*3600
+
+def parse_votable(data, columns=None, text_columns=False):
+  """Parses raw votable xml, decoding only the given columns (and any text columns if text_columns is set) where possible.
+     Falls back to a full astropy votable for anything the fast reader doesn't handle."""
+  start = time.time()
+  try:
+    table, parser = read_votable(StringIO.StringIO(data), columns, text_columns), "votable"
+  except VOTableFallback:
     with warnings.catch_warnings():
       warnings.simplefilter("ignore") # suppress astropy warnings
-      return astropy.io.votable.parse_single_table(xml_file) # parse xml to astropy votable
+      import astropy.io.votable
+      table, parser = astropy.io.votable.parse_single_table(StringIO.StringIO(data)), "astropy" # parse xml to astropy votable
+  metrics.count("parsing", parser, calls=1, seconds=time.time() - start, bytes=len(data))
+  return table
+
+def get_votable(url, columns=None, text_columns=False):
+  """Fetches from the web (or the response cache) and returns data for a source, in a votable of the given columns."""
+  print " ", url
+  try:
+    return parse_votable(fetch(url), columns, text_columns)
   except:
     print "  Could not download or interpret data from %s. You may not be connected to the Internet or the input data contains unrecognised names or coordinates." % url
 
@@ -492,3 +2279,175 @@ def e_bv_to_extinction(e_bv, freq):
 
   A_lambda = A_V * (a + b/R_V) # R_V is extinction factor
   return 10**(0.4*A_lambda) # convert from magnitude
+
+def comoving_integral(z):
+  """Calculates integral [0, z] dz/E(z) for an array of redshifts by interpolating a cumulative integral
+     tabulated (for the current cosmology) on a grid with spacing Z_STEP, which is extended as needed up to Z_MAX_TABULATED.
+     The rest of the integral for any higher redshifts is integrated in log(1+z) for each of them, so that a bad redshift
+     can't make the grid arbitrarily large."""
+  # E(z) = sqrt( O_M(1+z)^3 + O_k(1+z)^2 + O_Lambda )
+  O_k = 1 - O_M - O_Lambda
+  E = lambda z: numpy.sqrt(O_M*(1+z)**3 + O_k*(1+z)**2 + O_Lambda)
+  lowest, highest, integral = comoving_integrals.get((O_M, O_Lambda), (0, 0, numpy.zeros(1)))
+  tabulated = numpy.minimum(z, Z_MAX_TABULATED)
+  if len(z) and (tabulated.min() < lowest*Z_STEP or tabulated.max() > highest*Z_STEP): # tabulate over a wider range
+    lowest = min(lowest, int(math.floor(tabulated.min()/Z_STEP)))
+    highest = max(highest, min(2*int(math.ceil(tabulated.max()/Z_STEP)), int(round(Z_MAX_TABULATED/Z_STEP)))) # leave room to grow
+    grid = Z_STEP*numpy.arange(lowest, highest+1) # includes zero exactly
+    reciprocal = 1/E(grid)
+    integral = numpy.concatenate(([0.], numpy.cumsum((reciprocal[1:] + reciprocal[:-1])*Z_STEP/2))) # trapezium rule
+    integral -= integral[-lowest] # measured from zero
+    comoving_integrals[(O_M, O_Lambda)] = lowest, highest, integral
+  result = numpy.interp(tabulated, Z_STEP*numpy.arange(lowest, highest+1), integral)
+  beyond = z > Z_MAX_TABULATED
+  if beyond.any(): # integral [Z_MAX_TABULATED, z] (1+z)/E(z) dlog(1+z), a row of the grid for each redshift
+    x = numpy.linspace(numpy.zeros(beyond.sum()), numpy.log1p(z[beyond]) - math.log1p(Z_MAX_TABULATED), Z_BEYOND_STEPS+1, axis=-1) + math.log1p(Z_MAX_TABULATED)
+    result[beyond] += numpy.trapz(numpy.exp(x)/E(numpy.expm1(x)), x, axis=-1)
+  return result
+
+def luminosity_distance(z):
+  """Calculates the luminosity distance (in metres) for a redshift or an array of redshifts.
+     Results are memoised by redshift and cosmology."""
+  z = numpy.asarray(z, dtype=float)
+  missing = numpy.array(sorted(set(redshift for redshift in z.ravel().tolist() if redshift == redshift and (redshift, O_M, O_Lambda, H_0) not in luminosity_distances)), dtype=float) # nan can't be a key
+  known = numpy.isfinite(missing) & (missing > -1) # unknown redshifts have no distance
+
+  # we need to calculate the total line-of-sight comoving distance for each redshift
+  # D_C = c/H_0 * integral [0, z] dz/E(z)
+  D_C = numpy.nan*numpy.ones(missing.shape)
+  D_C[known] = (c/1000.)/H_0 * comoving_integral(missing[known]) # c in km/s
+
+  # assuming a flat universe the transverse comoving distance equals the radial comoving distance
+  D_M = D_C
+
+  # the luminosity distance is given by D_L = (1+z)D_M (in units of Mpc)
+  D_L = (1+missing)*D_M
+
+  # converting to units of metres
+  luminosity_distances.update(((redshift, O_M, O_Lambda, H_0), d_l) for redshift, d_l in zip(missing.tolist(), (3.086e22*D_L).tolist()))
+  return numpy.array([luminosity_distances.get((redshift, O_M, O_Lambda, H_0), numpy.nan) for redshift in z.ravel().tolist()]).reshape(z.shape)
+
+def luminosities(flux, extinction, z):
+  """Converts arrays of fluxes (in Jy) and extinctions at a redshift (or matching array of redshifts) to luminosities in W/Hz."""
+  d_l = luminosity_distance(z)
+  return 4*math.pi*(d_l**2)*numpy.asarray(flux)*numpy.asarray(extinction)*1e-26/(1+numpy.asarray(z))
+
+def uv_spectra(sources):
+  """Returns the log10 rest-frame frequencies and luminosities of all of the sources' data points within UV_FIT_RANGE that have a
+     positive luminosity, with the position in the list of the source each belongs to, calculated for all of the sources at once."""
+  owners = numpy.repeat(numpy.arange(len(sources)), [len(source.points) for source in sources])
+  freqs, fluxes, extinctions = (numpy.array([getattr(point, name) for source in sources for point in source.points], dtype=float) for name in ("freq", "flux", "extinction"))
+  z = numpy.array([source.z for source in sources], dtype=float)[owners]
+  with numpy.errstate(all="ignore"): # unknown redshifts and zero or negative fluxes give no logarithm, and are left out as gnuplot leaves them out
+    x = numpy.log10((1+z)*freqs)
+    y = numpy.log10(luminosities(fluxes, extinctions, z))
+  lower, upper = numpy.log10(UV_FIT_RANGE)
+  fitted = (lower <= x) & (x <= upper) & numpy.isfinite(y)
+  return owners[fitted], x[fitted], y[fitted]
+
+def fit_power_laws(owners, x, y, count):
+  """Fits y = alpha*x + C by least squares to the points of each of count groups at once, given the group each point belongs to.
+     Returns arrays of the number of points, alpha and C of each group, which are nan for groups without two distinct values of x."""
+  points = numpy.bincount(owners, minlength=count)
+  lowest, highest = numpy.inf*numpy.ones(count), -numpy.inf*numpy.ones(count)
+  numpy.minimum.at(lowest, owners, x)
+  numpy.maximum.at(highest, owners, x)
+  with numpy.errstate(all="ignore"):
+    mean_x = numpy.bincount(owners, x, count)/points
+    mean_y = numpy.bincount(owners, y, count)/points
+    dx = x - mean_x[owners] # centred, so the sums don't lose precision
+    alpha = numpy.where(lowest < highest, numpy.bincount(owners, dx*(y - mean_y[owners]), count)/numpy.bincount(owners, dx*dx, count), numpy.nan)
+    return points, alpha, mean_y - alpha*mean_x
+
+def ionising_photon_rates(alpha, C):
+  """Calculates log10 of the ionising photon rate (photons/s), the integral of L_v/hv from the lowest ionisation frequency up,
+     for arrays of power law luminosities L_v = 10**C * v**alpha. This is -10**C/(alpha*h) * v**alpha as in plot.sh,
+     so it is nan unless alpha < 0."""
+  with numpy.errstate(all="ignore"):
+    return numpy.where(alpha < 0, numpy.log10(-1/(alpha*h)) + C + alpha*math.log10(LOWEST_IONISATION_FREQUENCY), numpy.nan)
+
+class UVFitTable:
+  """Collects the uv data points of sources as they are analysed, then fits a power law to every source's uv spectrum at once
+     and writes a summary table of the fits and ionising photon rates, one line per source in input order."""
+  header = "index name z points alpha C ion_rate"
+
+  def __init__(self, path):
+    self.path = path
+    self.sources = [] # (index, name, z) of each source
+    self.spectra = [(numpy.zeros(0, dtype=int), numpy.zeros(0), numpy.zeros(0))] # (owners, x, y) of each batch of sources
+
+  def add(self, sources):
+    """Adds the uv data points of a list of sources."""
+    owners, x, y = uv_spectra(sources)
+    self.spectra.append((owners + len(self.sources), x, y))
+    self.sources.extend((source.index, source.name.replace(" ",""), source.z) for source in sources)
+
+  def save(self):
+    """Fits every source's spectrum and writes the table. Returns the number of sources with an ionising photon rate."""
+    owners, x, y = (numpy.concatenate(arrays) for arrays in zip(*self.spectra))
+    points, alpha, C = fit_power_laws(owners, x, y, len(self.sources))
+    ion_rates = ionising_photon_rates(alpha, C)
+    write_uv_fit_table(self.path, ["%d %s %.5e %d %.5e %.5e %.5e" % (source + row) for source, row in zip(self.sources, zip(points.tolist(), alpha.tolist(), C.tolist(), ion_rates.tolist()))])
+    return int(numpy.isfinite(ion_rates).sum())
+
+def write_uv_fit_table(path, lines):
+  """Writes the lines of a uv fit table, sorted by index."""
+  temp_path = "%s.%d.tmp" % (path, os.getpid())
+  with open(temp_path, "w") as table:
+    print >> table, UVFitTable.header
+    for line in sorted(lines, key=lambda line: int(line.split(" ", 1)[0])):
+      print >> table, line
+  os.rename(temp_path, path) # never leave a partial table
+
+def extinction_coefficients(x):
+  """Calculates A_lambda/A_V for an array of wavenumbers (inverse micrometres), evaluating each regime of
+     equations (1) through (4) in http://ads.nao.ac.jp/abs/1989ApJ...345..245C over masked parts of the array.
+     Matches e_bv_to_extinction bit for bit."""
+  x = numpy.asarray(x, dtype=float)
+  power = numpy.power # the ufunc calls C pow like python's ** (the ** operator would square by multiplication instead)
+  a = numpy.zeros(x.shape) # such that extinction will be 1 by default
+  b = numpy.zeros(x.shape)
+  infrared = (0.3<=x) & (x<=1.1)
+  optical = (1.1<x) & (x<=3.3) # boundaries belong to the earlier regime as in e_bv_to_extinction
+  ultraviolet = (3.3<x) & (x<=8)
+
+  x_ir = x[infrared]
+  a[infrared] = 0.574*power(x_ir, 1.61)
+  b[infrared] = -0.527*power(x_ir, 1.61)
+
+  y = x[optical] - 1.82
+  a[optical] = 1 + 0.17699*y - 0.50447*power(y, 2) - 0.02427*power(y, 3) + 0.72085*power(y, 4) \
+               + 0.01979*power(y, 5) - 0.77530*power(y, 6) + 0.32999*power(y, 7)
+  b[optical] = 1.41338*y + 2.28305*power(y, 2) + 1.07233*power(y, 3) - 5.38434*power(y, 4) \
+               - 0.62251*power(y, 5) + 5.30260*power(y, 6) - 2.09002*power(y, 7)
+
+  x_uv = x[ultraviolet]
+  far_ultraviolet = x_uv>=5.9
+  F_a = numpy.where(far_ultraviolet, -0.04473*power(x_uv - 5.9, 2) - 0.009779*power(x_uv - 5.9, 3), 0)
+  F_b = numpy.where(far_ultraviolet, 0.2130*power(x_uv - 5.9, 2) + 0.1207*power(x_uv - 5.9, 3), 0)
+  a[ultraviolet] = 1.752 - 0.316*x_uv - 0.104/(power(x_uv - 4.67, 2) + 0.341) + F_a
+  b[ultraviolet] = -3.090 + 1.825*x_uv + 1.206/(power(x_uv - 4.62, 2) + 0.263) + F_b
+
+  return a + b/R_V # R_V is extinction factor
+
+def e_bv_to_extinctions(e_bv, freq):
+  """Calculates extinctions for arrays of E(B-V)s and frequencies (broadcast together) in one call.
+     Matches e_bv_to_extinction element by element."""
+  A_V, x = numpy.broadcast_arrays(numpy.asarray(e_bv, dtype=float), (numpy.asarray(freq, dtype=float)/c)/1e6) # wavenumbers in inverse micrometres
+  with numpy.errstate(all="ignore"):
+    valid = numpy.isfinite(A_V) & numpy.isfinite(1/A_V) # extinction defaults to 1 if zero, inf or nan
+    A_lambda = A_V * extinction_coefficients(x)
+    return numpy.where(valid, numpy.power(10., 0.4*A_lambda), 1.) # convert from magnitude
+
+def band_extinction(e_bv, freq):
+  """Calculates an extinction given an E(B-V) and one of the fixed WISE, 2MASS or GALEX band frequencies,
+     using the precomputed A_lambda/A_V for the band. Matches e_bv_to_extinction."""
+  A_V = e_bv
+  try:
+    int(1/A_V) + int(A_V) # will error if zero, inf or nan
+  except:
+    return 1. # extinction defaults to 1
+  return 10**(0.4*(A_V*BAND_EXTINCTION_COEFFICIENTS[freq])) # convert from magnitude
+
+BAND_EXTINCTION_COEFFICIENTS = dict(zip(WISE_FREQUENCIES + TWOMASS_FREQUENCIES + GALEX_FREQUENCIES, \
+  extinction_coefficients((numpy.array(WISE_FREQUENCIES + TWOMASS_FREQUENCIES + GALEX_FREQUENCIES)/c)/1e6).tolist())) # A_lambda/A_V for each band
@@ -1,106 +1,279 @@
 #!/usr/bin/env python2
 
-import libned, argparse, sys, os, ConfigParser
+import libned, argparse, sys, os, multiprocessing.pool, json, subprocess, signal
 
 parser = argparse.ArgumentParser(description="Scripts to access NASA/IPAC Extragalactic Database (NED), Wide-Field Infrared Survey Explorer (WISE), Two Micron All Sky Survey (2MASS), and Galaxy Evolution Explorer (GALEX) online data.")
 parser.add_argument("input", nargs="?", type=argparse.FileType("rU"), default=sys.stdin, help="newline-separated input data file (will take manual input if not specified)")
 parser.add_argument("-f", "--file", type=argparse.FileType("w"), default=sys.stdout, help="output filename")
 parser.add_argument("-p", "--plot", metavar="DIR", type=str, help="plot mode (must specify directory for output data)")
+parser.add_argument("--render", metavar="N", type=int, default=0, help="in plot mode, also render each plot file to a postscript plot with plot.sh (using gnuplot), running N at once (default: 0, don't render)")
+parser.add_argument("--cache-dir", metavar="DIR", type=str, default=os.path.join(os.path.expanduser("~"), ".ned_cache"), help="directory for the on-disk response cache (default: ~/.ned_cache)")
+parser.add_argument("--cache-ttl", metavar="DAYS", type=float, default=30, help="days before a cached response expires (default: 30)")
+parser.add_argument("--cache-size", metavar="MB", type=float, default=1024, help="maximum size of the response cache in megabytes (default: 1024)")
+parser.add_argument("--no-cache", action="store_true", help="always download and don't cache responses")
+parser.add_argument("--refresh", action="store_true", help="ignore cached responses but cache the fresh downloads")
+parser.add_argument("-s", "--stream", action="store_true", help="process sources one at a time and write each source's output as soon as it is complete")
+parser.add_argument("-w", "--workers", metavar="N", type=int, default=8, help="number of concurrent downloads (default: 8)")
+parser.add_argument("--rate", metavar="RPS", type=float, default=1., help="maximum requests per second to each host, 0 for unlimited (default: 1)")
+parser.add_argument("-b", "--batch", metavar="N", type=int, default=0, help="fetch WISE, 2MASS and GALEX data for up to N sources per query (default: 0, one query per source)")
+parser.add_argument("--host-rate", metavar="HOST=RPS", action="append", default=[], help="maximum requests per second to a specific host (may be repeated)")
+parser.add_argument("--timeout", metavar="SECONDS", type=float, default=60., help="seconds to wait for a host to connect or send data (default: 60)")
+parser.add_argument("--coalesce-radius", metavar="ARCSEC", type=float, default=0., help="share WISE, 2MASS and GALEX queries between sources within this many arcseconds of each other (default: 0, only identical positions)")
+parser.add_argument("--checkpoint", metavar="FILE", type=str, help="journal each source's progress to a file so that an interrupted run can be resumed")
+parser.add_argument("--resume", action="store_true", help="skip the work already journaled in the checkpoint file")
+parser.add_argument("--retries", metavar="N", type=int, default=3, help="times to retry a request after a timeout, dropped connection or overloaded host (default: 3)")
+parser.add_argument("--format", choices=libned.OUTPUT_FORMATS, default="text", help="output format: text formatted as in ned.conf, or a table of every output field as csv, npz, hdf5 or parquet (default: text)")
+parser.add_argument("--shard", metavar="I/N", help="process only the I-th of N shards of the input (by a hash of each line), recording a sidecar alongside the output for --merge")
+parser.add_argument("--merge", metavar="SHARD_OUTPUT", nargs="+", help="merge the outputs of every shard of a run (and their plot files, with --plot) into one output, as from a single run")
+parser.add_argument("--serve", metavar="ADDRESS", help="run a long-running lookup server on [HOST:]PORT or a Unix socket path instead of processing input, keeping the results of looked up sources in memory")
+parser.add_argument("--keep", metavar="N", type=int, default=100000, help="sources whose results a lookup server keeps in memory, the least recently used being dropped (default: 100000)")
+parser.add_argument("--server", metavar="ADDRESS", help="look sources up with a lookup server (started with --serve) instead of processing them here, streaming their results as with --stream")
+parser.add_argument("--metrics", metavar="FILE", type=argparse.FileType("w"), help="write a JSON summary of the time spent in each stage, requests, bytes, failures and cache hits by host, parsing time and data points")
+parser.add_argument("--progress", metavar="SECONDS", type=float, default=0., help="print progress and the estimated time remaining every so many seconds (default: 0, never)")
+parser.add_argument("--profile", action="store_true", help="profile every thread and report the functions taking the most time (included in any metrics summary)")
 args = vars(parser.parse_args())
 in_file = args["input"] # a file-like object
 out_file = args["file"] # a file-like object
 plot_dir = args["plot"] # a string of a directory
 
-print "READING CONFIGURATION FILE ned.conf"
-config = ConfigParser.RawConfigParser()
-config.read("ned.conf")
-print "BUILDING INPUT REGEXP..."
-libned.input_fields = config.get("Format", "input").strip().split()
-libned.input_regexp = libned.build_input_regexp()
+if args["merge"]:
+  try:
+    merged = libned.merge_shards(args["merge"], out_file, plot_dir)
+  except ValueError as e:
+    parser.error(str(e))
+  print "MERGED %d SOURCES FROM %d SHARDS INTO %s" % (merged, len(args["merge"]), out_file.name)
+  out_file.close()
+  parser.exit()
+try:
+  shard = libned.parse_shard(args["shard"]) if args["shard"] else None
+except ValueError:
+  parser.error("shards must be given as I/N, from 1/N to N/N")
+if shard and out_file is sys.stdout:
+  parser.error("--shard requires --file")
+if args["render"] and not plot_dir:
+  parser.error("--render requires --plot")
+if args["server"] and args["checkpoint"]:
+  parser.error("--checkpoint can't be used with --server, which keeps the results instead")
+if args["serve"] and args["checkpoint"]:
+  parser.error("--checkpoint can't be used with --serve, which keeps the results instead")
+server_address = libned.parse_lookup_address(args["server"]) if args["server"] else None
+if server_address:
+  try:
+    libned.lookup_status(server_address, args["timeout"])
+  except EnvironmentError as e:
+    parser.error("can't reach the lookup server at %s: %s" % (args["server"], e))
+
+def locate((index, source)):
+  """Fetches and parses a source's NED position data."""
+  source.get_and_parse_ned_position()
+  source.complete("position", index)
+
+def begin_stage(heading):
+  """Announces a stage of the run and starts timing it."""
+  libned.metrics.stage(heading.rstrip(".:").lower())
+  print heading
+
+def write_output(source):
+  """Writes a source's results to the output file (or the point writer) and counts its data points by data source."""
+  with libned.metrics.timer("output", "formatting"):
+    if point_writer:
+      point_writer.write(source)
+      if shard_index:
+        shard_index.add(source)
+    else:
+      start = out_file.tell() if shard_index else None
+      print >> out_file, str(source)
+      if shard_index:
+        shard_index.add(source, start, out_file.tell())
+  counts = {}
+  for point in source.points:
+    counts[point.data_source] = counts.get(point.data_source, 0) + 1
+  for data_source, count in counts.items():
+    libned.metrics.count("points", data_source, points=count)
+
+def write_plot_output(source):
+  """Writes a source's plot-ready .dat file to the plot directory."""
+  try:
+    with libned.metrics.timer("output", "plots"):
+      plot_file = open(os.path.join(plot_dir, source.name.replace(" ","").replace(os.sep, "") + ".dat"), "w")
+      print >> plot_file, source.plot_output()
+      plot_file.close()
+    if shard_index:
+      shard_index.add_plot(source, os.path.basename(plot_file.name))
+    print "%s PLOT OUTPUT WRITTEN TO %s" % (source.name, plot_file.name)
+  except:
+    print "COULD NOT WRITE PLOT OUTPUT FOR %s" % source.name
+  else:
+    plot_files[plot_file.name] = True
+
+def render_plot(path):
+  """Renders a plot file to postscript with plot.sh. Gnuplot's fit output is discarded, since the UV fit table has the fits."""
+  with open(os.devnull, "w") as devnull:
+    status = subprocess.call(["sh", os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "plot.sh"), path], stdout=devnull, stderr=devnull)
+  print ("PLOT RENDERED TO %s" if status == 0 else "COULD NOT RENDER PLOT %s") % (os.path.splitext(path)[0] + ".ps")
+
+if not args["no_cache"]:
+  libned.cache = libned.ResponseCache(args["cache_dir"], ttl=args["cache_ttl"]*24*3600, max_size=args["cache_size"]*1024*1024, refresh=args["refresh"])
+try:
+  libned.throttle = libned.HostThrottle(args["rate"], dict((host.lower(), float(rate)) for host, rate in (host_rate.split("=") for host_rate in args["host_rate"])))
+except ValueError:
+  parser.error("host rates must be given as HOST=RPS")
+if args["resume"] and not args["checkpoint"]:
+  parser.error("--resume requires --checkpoint")
+if args["checkpoint"]:
+  libned.checkpoint = libned.Checkpoint(args["checkpoint"], resume=args["resume"])
+libned.client = libned.HTTPClient(timeout=args["timeout"], retries=args["retries"], max_idle=args["workers"])
+if args["format"] != "text" and out_file is sys.stdout: # csv rows would be mixed up with the progress printed to stdout
+  parser.error("--format %s requires --file" % args["format"])
+if args["profile"]:
+  libned.metrics.profile()
+pool = multiprocessing.pool.ThreadPool(args["workers"], libned.metrics.profile if args["profile"] else None) # runs downloads concurrently
+if args["progress"] > 0:
+  libned.metrics.report_progress(args["progress"])
+
+begin_stage("READING CONFIGURATION FILE ned.conf")
+config = libned.Config.read("ned.conf")
+try:
+  config.validate()
+except ValueError as e:
+  parser.error(str(e))
+begin_stage("APPLYING CONFIGURATION AND OPENING LOCAL CATALOGUES AND MAPS...")
+config.apply()
 print "INPUT REGEXP SET TO:"
 print libned.input_regexp.pattern
-print "VALIDATING OUTPUT FORMAT..."
-libned.DataPoint.repr_format_string = config.get("Format", "output")
-valid_output_fields = {\
-  "index": -1, \
-  "name": None, \
-  "ned_name": None, \
-  "nvss_id": None, \
-  "search_name": None, \
-  "z": float("inf"), \
-  "num": -1, \
-  "freq": float("inf"), \
-  "flux": float("inf"), \
-  "data_source": None, \
-  "flag": 'a', \
-  "lat": float("inf"), \
-  "lon": float("inf"), \
-  "ned_lat": float("inf"), \
-  "ned_lon": float("inf"), \
-  "input_lat": float("inf"), \
-  "input_lon": float("inf"), \
-  "offset_from_ned": float("inf"), \
-  "input_offset_from_ned": float("inf"), \
-  "e_bv": float("inf"), \
-  "extinction": 1.\
- }
-for input_field in libned.input_fields: # add custom input fields to valid output fields
-  if input_field not in valid_output_fields:
-    valid_output_fields[input_field] = ""
-try:
-  libned.DataPoint.repr_format_string % valid_output_fields
-except:
-  raise Exception("Mismatch between output and input fields. Check ned.conf.")
-else:
-  print "OUTPUT FORMAT SET TO:"
-  print libned.DataPoint.repr_format_string
-print
-print "GETTING AND ANALYSING INPUT DATA..."
-sources = [libned.Source(line) for line in in_file if libned.parse_line(line)] # could be memoized
-print
-print "DOWNLOADING AND ANALYSING NED POSITION DATA..."
-[source.get_and_parse_ned_position() for source in sources] # fetch, parse and store ned position data
-print
-print "DOWNLOADING EXTINCTION DATA..."
-[setattr(source, "dust", source.get_dust_xml()) for source in sources] # fetch extinction data
-print "ANALYSING EXTINCTION DATA..."
-[source.parse_dust() for source in sources] # parse and store dust data
-print
-print "DOWNLOADING NED SED DATA..."
-[setattr(source, "ned_sed", source.get_ned_sed_votable()) for source in sources] # fetch ned sed data
-print "ANALYSING NED SED DATA..."
-[source.parse_ned_sed(index+1) for index, source in enumerate(sources)] # parse and store ned sed data
-print
-print "DOWNLOADING WISE DATA..."
-[setattr(source, "wise", source.get_wise_votable()) for source in sources] # fetch wise data
-print "ANALYSING WISE DATA..."
-[source.parse_wise(index+1) for index, source in enumerate(sources)] # parse and store wise data (including any 2mass data)
-print
-print "DOWNLOADING ANY MISSING 2MASS DATA..."
-[setattr(source, "twomass", source.get_twomass_votable()) for source in sources if not source.twomass] # fetch 2mass data if missing
-print "ANALYSING 2MASS DATA..."
-[source.parse_twomass(index+1) for index, source in enumerate(sources)] # parse and store 2mass data
-print
-print "DOWNLOADING GALEX DATA..."
-[setattr(source, "galex", source.get_galex_votable()) for source in sources] # fetch galex data
-print "ANALYSING GALEX DATA..."
-[source.parse_galex(index+1) for index, source in enumerate(sources)] # parse and store galex data
+print "OUTPUT FORMAT SET TO:"
+print libned.DataPoint.repr_format_string
+print "NED SED FILTERS SET TO:"
+print "\n".join(regexp.pattern for regexp in libned.ned_sed_filters)
+if "dust" in libned.backends:
+  print "EXTINCTION DATA WILL BE LOOKED UP IN %s" % libned.backends["dust"].directory
+for stage in ("wise", "twomass", "galex"):
+  if stage in libned.backends:
+    print "%s DATA WILL BE SEARCHED FOR IN %s" % (stage.upper(), libned.backends[stage].path)
+if args["serve"]:
+  print
+  begin_stage("SERVING LOOKUPS...")
+  try:
+    server = libned.serve_lookups(libned.parse_lookup_address(args["serve"]), libned.LookupService(pool, args["keep"], window=4*args["workers"]))
+  except EnvironmentError as e:
+    parser.error("can't serve lookups on %s: %s" % (args["serve"], e))
+  print "LOOKUP SERVER LISTENING ON %s (STOP WITH Ctrl+C)" % args["serve"]
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit()) # stop cleanly when stopped as a service too
+  try:
+    server.serve_forever()
+  except (KeyboardInterrupt, SystemExit):
+    pass
+  server.server_close()
+  print "FINISHED"
+  parser.exit()
+delimiter = "," if in_file.name.lower().endswith(".csv") else None # otherwise whitespace
+shard_index = libned.ShardIndex(out_file.name, shard, args["format"], plot_dir) if shard else None
+point_writer = libned.open_point_writer(args["format"], out_file) if args["format"] != "text" else None # after input_fields is set
+uv_fit_table = libned.UVFitTable(os.path.join(plot_dir, libned.UV_FIT_TABLE)) if plot_dir else None
+plot_files = {} # written, by name, so that a plot file rewritten for a source with the same name is rendered once
 print
-print "RESULTS"
-for source in sources: print >> out_file, source
-print "OUTPUT WRITTEN TO %s" % out_file.name
+if args["stream"] or server_address:
+  begin_stage("STREAMING INPUT DATA THROUGH THE LOOKUP SERVER..." if server_address else "STREAMING INPUT DATA...")
+  if in_file is not sys.stdin: # count the sources for progress reports
+    libned.metrics.total = len(libned.Checkpoint.STAGES)*sum(1 for line, data in libned.read_input(in_file, delimiter) if shard is None or line in shard)
+    in_file.seek(0)
+  sources = libned.read_sources(in_file, delimiter, shard)
+  for source in libned.look_up(server_address, sources, batch_size=4*args["workers"]) if server_address else libned.stream(pool, sources, window=4*args["workers"]):
+    write_output(source)
+    out_file.flush() # results survive a later crash
+    print "%s OUTPUT WRITTEN TO %s" % (source.name, out_file.name)
+    if plot_dir:
+      write_plot_output(source)
+      uv_fit_table.add([source])
+else:
+  begin_stage("GETTING AND ANALYSING INPUT DATA...")
+  sources = libned.load_sources(in_file, delimiter, shard)
+  libned.metrics.total = len(libned.Checkpoint.STAGES)*len(sources)
+  [source.resume(source.index) for source in sources] # restore any work journaled by an interrupted run
+  print
+  begin_stage("DOWNLOADING AND ANALYSING NED POSITION DATA...")
+  pool.map_async(locate, libned.pending(sources, "position")).get(sys.maxint) # fetch, parse and store ned position data
+  print
+  begin_stage("DOWNLOADING EXTINCTION, NED SED AND WISE DATA...")
+  pending = dict((stage, libned.pending(sources, stage)) for stage in ("dust", "ned_sed", "wise"))
+  groups = dict((stage, libned.coalesce([source for index, source in pending[stage]], stage, args["coalesce_radius"])) for stage in pending)
+  leaders = dict((stage, [group[0] for group in groups[stage]]) for stage in groups) # only these make queries
+  if "dust" in libned.backends:
+    libned.look_up_dust(leaders["dust"]) # all at once
+  libned.download_all(pool, \
+    libned.fetch_jobs(leaders["dust"], "dust", libned.Source.get_dust_xml) if "dust" not in libned.backends else [], \
+    libned.fetch_jobs(leaders["ned_sed"], "ned_sed", libned.Source.get_ned_sed_votable), \
+    libned.gator_batch_jobs(leaders["wise"], "wise", libned.WISE_CATALOG, libned.WISE_COLUMNS, args["batch"]) if args["batch"] and "wise" not in libned.backends else libned.fetch_jobs(leaders["wise"], "wise", libned.Source.get_wise_votable)\
+   ) # fetch extinction, ned sed and wise data
+  [libned.fan_out(groups[stage], stage) for stage in groups] # share data with duplicates
+  begin_stage("ANALYSING EXTINCTION DATA...")
+  [source.parse_dust() or source.complete("dust", index) for index, source in pending["dust"]] # parse and store dust data
+  begin_stage("ANALYSING NED SED DATA...")
+  [source.parse_ned_sed(index) or source.complete("ned_sed", index) for index, source in pending["ned_sed"]] # parse and store ned sed data
+  begin_stage("ANALYSING WISE DATA...")
+  [source.parse_wise(index) or source.complete("wise", index) for index, source in pending["wise"]] # parse and store wise data (including any 2mass data)
+  print
+  begin_stage("DOWNLOADING ANY MISSING 2MASS DATA AND GALEX DATA...")
+  pending = dict((stage, libned.pending(sources, stage)) for stage in ("twomass", "galex"))
+  groups = {\
+    "twomass": libned.coalesce([source for index, source in pending["twomass"] if not source.twomass], "twomass", args["coalesce_radius"]), \
+    "galex": libned.coalesce([source for index, source in pending["galex"]], "galex", args["coalesce_radius"])\
+   }
+  leaders = dict((stage, [group[0] for group in groups[stage]]) for stage in groups)
+  libned.download_all(pool, \
+    libned.gator_batch_jobs(leaders["twomass"], "twomass", libned.TWOMASS_CATALOG, libned.TWOMASS_COLUMNS, args["batch"]) if args["batch"] and "twomass" not in libned.backends else libned.fetch_jobs(leaders["twomass"], "twomass", libned.Source.get_twomass_votable), \
+    libned.galex_batch_jobs(leaders["galex"], args["batch"]) if args["batch"] and "galex" not in libned.backends else libned.fetch_jobs(leaders["galex"], "galex", libned.Source.get_galex_votable)\
+   ) # fetch 2mass data if missing and galex data
+  [libned.fan_out(groups[stage], stage) for stage in groups] # share data with duplicates
+  begin_stage("ANALYSING 2MASS DATA...")
+  [source.parse_twomass(index) or source.complete("twomass", index) for index, source in pending["twomass"]] # parse and store 2mass data
+  begin_stage("ANALYSING GALEX DATA...")
+  [source.parse_galex(index) or source.complete("galex", index) for index, source in pending["galex"]] # parse and store galex data
+  print
+  begin_stage("RESULTS")
+  for source in sources: write_output(source)
+  print "OUTPUT WRITTEN TO %s" % out_file.name
+
+  if plot_dir:
+    print
+    begin_stage("WRITING PLOT OUTPUT...")
+    libned.luminosity_distance([source.z for source in sources]) # calculate all distances at once
+    for source in sources:
+      write_plot_output(source)
+    uv_fit_table.add(sources)
 
 if plot_dir:
   print
-  for source in sources:
-    try:
-      plot_file = open(os.path.join(plot_dir, source.name.replace(" ","").replace(os.sep, "") + ".dat"), "w")
-      print >> plot_file, source.plot_output()
-      plot_file.close()
-      print "%s PLOT OUTPUT WRITTEN TO %s" % (source.name, plot_file.name)
-    except:
-      print "COULD NOT WRITE PLOT OUTPUT FOR %s" % source.name
+  begin_stage("FITTING UV SPECTRA...")
+  with libned.metrics.timer("output", "uv fits"):
+    fitted = uv_fit_table.save() # all sources at once
+  print "UV FITS WRITTEN TO %s (%d OF %d SOURCES WITH AN IONISING PHOTON RATE)" % (uv_fit_table.path, fitted, len(uv_fit_table.sources))
+if args["render"]:
+  begin_stage("RENDERING PLOTS...")
+  renderer = multiprocessing.pool.ThreadPool(args["render"]) # each task runs a gnuplot process
+  renderer.map_async(render_plot, sorted(plot_files)).get(sys.maxint)
+  renderer.close()
 
 print
+print "%d REQUESTS SAVED BY COALESCING DUPLICATE QUERIES" % libned.requests_saved
+if args["profile"]:
+  pool.close()
+  pool.join() # so that every thread's profile is complete
+summary = libned.metrics.summary()
+if args["metrics"]:
+  json.dump(summary, args["metrics"], indent=2, sort_keys=True)
+  args["metrics"].close()
+  print "METRICS WRITTEN TO %s" % args["metrics"].name
+if args["profile"]:
+  print "FUNCTIONS TAKING THE MOST TIME (CUMULATIVE SECONDS OVER ALL THREADS):"
+  for entry in summary["profile"]["cumulative"]:
+    print "  %10.3f %10d  %s" % (entry["cumulative_seconds"], entry["calls"], entry["function"])
 print "FINISHED"
+if libned.checkpoint:
+  libned.checkpoint.close()
+if point_writer:
+  point_writer.close()
+if shard_index:
+  out_file.flush()
+  shard_index.save() # last, so that only complete shard outputs can be merged
 out_file.close() # close it at end since still need to print to stdout